@@ -60,8 +60,22 @@ def detect_corners(image):
     return corners
 
 
+class LatestFrame(object):
+    image = None
+
+
+def latest_frames():
+    while True:
+        yield LatestFrame.image
+
+
+# Re-detects only the regions changed since they were last detected
+candy_stream = detector.detect_stream(latest_frames())
+
+
 def draw_detection(image):
-    candies = detector.detect(image)
+    LatestFrame.image = image
+    candies = next(candy_stream)
     for candy in candies:
         cv2.polylines(image, np.int32([np.array(candy.box_coords)]), isClosed=True, color=(0, 0, 255),
                       lineType=cv2.LINE_AA, thickness=3)
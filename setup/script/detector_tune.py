@@ -0,0 +1,84 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+
+sys.path.append('../../webapp')
+
+from candysorter.config import get_config  # noqa: E402
+from candysorter.models.images.tune import (  # noqa: E402
+    config_block, evaluate, load_dataset, pareto_frontier, params_of, sample_params, tune
+)
+
+
+def print_trial(t, base):
+    changed = ', '.join('{}={}'.format(k, v) for k, v in t.params.items() if v != base[k])
+    print('{:8.1f} {:6.3f} {:6.3f} {:6.3f}  {}'.format(
+        t.latency * 1000, t.precision, t.recall, t.f1, changed or '(current config)'))
+
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(
+        description='Search the parameters of the candy detector for speed and accuracy.')
+    parser.add_argument('dataset', type=str,
+                        help='directory of calibrated images, with the candies of foo.jpg in '
+                             'foo.json')
+    parser.add_argument('--env', type=str, default=os.getenv('FLASK_ENV', 'dev'))
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to detect each image, of which the median is the latency')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-f1', type=float, default=None,
+                        help='f1 of the config block, by default that of the current config')
+    args = parser.parse_args()
+    logging.basicConfig()
+
+    dataset = load_dataset(args.dataset)
+    if not dataset:
+        print('No images with candies in {}'.format(args.dataset))
+        exit(1)
+    base = params_of(get_config(args.env))
+    print('{} images, {} candies, {} trials on {} processes'.format(
+        len(dataset), sum(len(boxes) for _, boxes in dataset), args.trials, args.processes))
+
+    trials = tune(dataset, sample_params(base, args.trials, seed=args.seed),
+                  processes=args.processes, repeat=args.repeat)
+    frontier = pareto_frontier(trials)
+
+    print('')
+    print('latency(ms) precision recall f1  parameters changed from the current config')
+    print_trial(trials[0], base)
+    print('--- pareto frontier')
+    for t in frontier:
+        print_trial(t, base)
+
+    min_f1 = trials[0].f1 if args.min_f1 is None else args.min_f1
+    chosen = [t for t in frontier if t.f1 >= min_f1]
+    if not chosen:
+        print('')
+        print('No parameters with f1 >= {:.3f}'.format(min_f1))
+        exit(1)
+    # The fastest with at least the f1, with the latency measured again alone in this process
+    best = evaluate(chosen[0].params, dataset, args.repeat)
+    print('')
+    print('# f1 {:.3f}, {:.1f} ms'.format(best.f1, best.latency * 1000))
+    print(config_block(best.params))
@@ -0,0 +1,42 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import io
+import json
+import logging
+import sys
+
+sys.path.append('../../webapp')
+
+from candysorter.models.images.filter import (  # noqa: E402
+    make_pickable_map, PICKABLE_MAP_FILE, save_pickable_map
+)
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(
+        description='Make the pickable map of the webapp from the calibration data of the arm.')
+    parser.add_argument('--adjust-data', type=str,
+                        default='../../robot-arm/calibration/adjust_data.json')
+    parser.add_argument('--out', type=str, default=PICKABLE_MAP_FILE)
+    args = parser.parse_args()
+    logging.basicConfig()
+
+    with io.open(args.adjust_data) as f:
+        pickables = make_pickable_map(json.load(f))
+    save_pickable_map(args.out, pickables)
+    print('{} of {} cells pickable, saved to {}'.format(pickables.sum(), pickables.size, args.out))
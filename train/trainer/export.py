@@ -0,0 +1,69 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import os
+
+import tensorflow as tf
+
+import trainer.model as model
+
+logger = logging.getLogger(__name__)
+
+
+def export_weights(train_dir):
+    """Exports the weights of the latest checkpoint in train_dir.
+
+    For checkpoints trained before the trainer exported the weights itself.
+    """
+    with tf.gfile.FastGFile(os.path.join(train_dir, 'params.json'), 'r') as f:
+        params = model.ModelParams.from_json(f.read())
+
+    ckpt = tf.train.get_checkpoint_state(train_dir)
+    if ckpt is None:
+        raise IOError('Checkpoints not found.')
+
+    weights_file = os.path.join(train_dir, model.WEIGHTS_FILE)
+    with tf.Graph().as_default():
+        mo = model.TransferModel(features_size=params.features_size,
+                                 num_classes=len(params.labels),
+                                 for_predict=True,
+                                 hidden_size=params.hidden_size)
+        with tf.Session() as sess:
+            mo.restore(sess, ckpt.model_checkpoint_path)
+            mo.export_weights(sess, weights_file)
+    return weights_file
+
+
+def main(_):
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-7s %(levelname)-7s %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description='Export the weights of the transfer model.')
+    parser.add_argument('--train_dir', type=str, default='train',
+                        help="Directory for checkpoints.")
+
+    args = parser.parse_args()
+
+    logger.info('Exported {}.'.format(export_weights(args.train_dir)))
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -20,12 +20,20 @@ import os
 import logging
 import json
 import sys
+import threading
 
+import numpy as np
 import tensorflow as tf
 import cv2
 
 INPUT_DATA_TENSOR_NAME = 'DecodeJpeg:0'
 FEATURE_TENSOR_NAME = 'pool_3/_reshape:0'
+# The decoded image resized to the input size in the graph, and the features before they are
+# reshaped for a batch of one
+RESIZED_DATA_TENSOR_NAME = 'ResizeBilinear:0'
+BATCH_FEATURE_TENSOR_NAME = 'pool_3:0'
+INPUT_SIZE = 299
+FEATURE_SIZE = 2048
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,55 +46,108 @@ class FeatureExtractor(object):
     """
     FeatureExtractor extracts 2048-dimension feature vectors from image files
     using inception-v3.
+
+    It runs all extractions in one session, which is closed by close() or at the end of a
+    with block. It can be shared by threads, which extract one at a time. intra_op_threads and
+    inter_op_threads are the thread pools of the session, 0 lets TensorFlow choose.
     """
 
-    def __init__(self, model_file):
+    def __init__(self, model_file, intra_op_threads=0, inter_op_threads=0):
         # load inception-v3 model
         self.graph = tf.Graph()
         with tf.gfile.FastGFile(model_file, 'rb') as f:
             graph_def = tf.GraphDef()
             graph_def.ParseFromString(f.read())
             with self.graph.as_default():
-                _ = tf.import_graph_def(graph_def, name='')
+                # ResizeBilinear is of a batch of one in the graph, so batches are fed to a
+                # placeholder in place of it
+                self.resized_data = tf.placeholder(
+                    tf.float32, (None, INPUT_SIZE, INPUT_SIZE, 3), 'resized_data')
+                batch_feature, = tf.import_graph_def(
+                    graph_def, name='inception',
+                    input_map={RESIZED_DATA_TENSOR_NAME: self.resized_data},
+                    return_elements=[BATCH_FEATURE_TENSOR_NAME])
+                self.batch_feature_op = tf.reshape(batch_feature, [-1, FEATURE_SIZE])
 
-            feature = tf.reshape(self.graph.get_tensor_by_name(FEATURE_TENSOR_NAME), [-1])
-        self.feature_op = feature
+        # Decode image
+        with self.graph.as_default():
+            self.image_path = tf.placeholder(tf.string, None, 'image_path')
+            self.image_op = tf.image.decode_jpeg(tf.read_file(self.image_path))
 
         self.saver = None
 
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads
+        ))
+        self._lock = threading.Lock()
+
     @classmethod
-    def from_model_dir(cls, model_dir):
-        return cls(os.path.join(model_dir, 'classify_image_graph_def.pb'))
+    def from_model_dir(cls, model_dir, **kwargs):
+        return cls(os.path.join(model_dir, 'classify_image_graph_def.pb'), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self.sess is not None:
+                self.sess.close()
+                self.sess = None
 
     def get_feature_vector(self, img_bgr):
-        with tf.Session(graph=self.graph) as sess:
-            feature_data = sess.run(
-                self.feature_op,
-                {INPUT_DATA_TENSOR_NAME: img_bgr}
-            )
-        return feature_data.reshape(-1, feature_data.shape[0])
+        return self.get_feature_vectors([img_bgr])
 
-    def get_feature_vectors_from_files(self, image_paths):
-        # Decode image
-        with self.graph.as_default():
-            image_path = tf.placeholder(tf.string, None, 'image_path')
-            image = tf.image.decode_jpeg(tf.read_file(image_path))
+    def get_feature_vectors(self, imgs, batch_size=16):
+        """Feature vectors of images as an N x 2048 matrix, extracted batch_size at a time.
 
+        The same as feeding each image to DecodeJpeg, but runs inception-v3 once for a batch.
+        """
+        features = [np.zeros((0, FEATURE_SIZE), dtype=np.float32)]
+        for i in range(0, len(imgs), batch_size):
+            resized = np.stack([resize_bilinear(img) for img in imgs[i:i + batch_size]])
+            features.append(self._run(self.batch_feature_op, {self.resized_data: resized}))
+        return np.concatenate(features)
+
+    def get_feature_vectors_from_files(self, image_paths):
         # Extract features
         features = []
-        with tf.Session(graph=self.graph) as sess:
-            for path in image_paths:
-                image_data = sess.run(
-                    image,
-                    {image_path: path}
-                )
-                feature_data = sess.run(
-                    self.feature_op,
-                    {INPUT_DATA_TENSOR_NAME: image_data}
-                )
-                features.append(feature_data)
+        for path in image_paths:
+            image_data = self._run(self.image_op, {self.image_path: path})
+            features.append(self.get_feature_vectors([image_data])[0])
         return features
 
+    def _run(self, fetches, feed_dict):
+        with self._lock:
+            if self.sess is None:
+                raise RuntimeError('FeatureExtractor is already closed.')
+            return self.sess.run(fetches, feed_dict)
+
+
+def resize_bilinear(img, size=INPUT_SIZE):
+    """img resized to size x size as float32, as ResizeBilinear of inception-v3 does.
+
+    That is tf.image.resize_bilinear without align_corners, which samples the pixels at
+    out * in_size / size rather than cv2.resize's pixel centers.
+    """
+    img = np.asarray(img, dtype=np.float32)
+
+    def _weights(in_size):
+        coords = np.arange(size, dtype=np.float32) * np.float32(in_size / size)
+        lower = coords.astype(np.int64)
+        return lower, np.minimum(lower + 1, in_size - 1), (coords - lower).astype(np.float32)
+
+    y0, y1, dy = _weights(img.shape[0])
+    x0, x1, dx = _weights(img.shape[1])
+    dx = dx[np.newaxis, :, np.newaxis]
+    top, bottom = img[y0], img[y1]
+    top = top[:, x0] + (top[:, x1] - top[:, x0]) * dx
+    bottom = bottom[:, x0] + (bottom[:, x1] - bottom[:, x0]) * dx
+    return top + (bottom - top) * dy[:, np.newaxis, np.newaxis]
+
 
 class ImagePathGeneratorForTraining(object):
     def __init__(self, image_dir, extension='jpg'):
@@ -175,11 +236,11 @@ def main():
         logger.info("writing label file: {}".format(labels_file))
         write_labels(path_gen.get_labels(), labels_file)
 
-    extractor = FeatureExtractor(model_file)
-    writer = FeaturesDataWriter(path_gen, extractor)
+    with FeatureExtractor(model_file) as extractor:
+        writer = FeaturesDataWriter(path_gen, extractor)
 
-    logger.info("writing features file: {}".format(features_file))
-    writer.write_features(features_file)
+        logger.info("writing features file: {}".format(features_file))
+        writer.write_features(features_file)
 
 
 if __name__ == "__main__":
@@ -15,13 +15,17 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import io
 import json
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import init_ops
 
 INPUT_DATA_TENSOR_NAME = 'DecodeJpeg:0'
 FEATURE_TENSOR_NAME = 'pool_3/_reshape:0'
+# Weights of the trained TransferModel for NumpyTransferModel, next to params.json
+WEIGHTS_FILE = 'weights.npz'
 
 
 class ModelParams(object):
@@ -113,13 +117,31 @@ class TransferModel(object):
         return optimizer.minimize(self.loss_op, global_step=self.global_step)
 
     def restore_and_predict(self, input_tensor, model_checkpoint_path):
-        saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.VARIABLES, scope='transfer'))
         with tf.Session() as sess:
-            sess.run(tf.initialize_all_variables())
-            saver.restore(sess, model_checkpoint_path)
-            prob = sess.run(self.softmax_op, self.feed_for_predict(input_tensor))
+            self.restore(sess, model_checkpoint_path)
+            prob = self.predict(sess, input_tensor)
         return prob
 
+    def restore(self, sess, model_checkpoint_path):
+        # in the graph of the model
+        saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.VARIABLES, scope='transfer'))
+        sess.run(tf.initialize_all_variables())
+        saver.restore(sess, model_checkpoint_path)
+
+    def predict(self, sess, input_tensor):
+        return sess.run(self.softmax_op, self.feed_for_predict(input_tensor))
+
+    def export_weights(self, sess, path):
+        # The weights and biases of the hidden and the logits layer, in the order created
+        hidden_weights, hidden_biases, logits_weights, logits_biases = sess.run(
+            tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='transfer')
+        )
+        buf = io.BytesIO()
+        np.savez(buf, hidden_weights=hidden_weights, hidden_biases=hidden_biases,
+                 logits_weights=logits_weights, logits_biases=logits_biases)
+        with tf.gfile.FastGFile(path, 'wb') as f:
+            f.write(buf.getvalue())
+
     def feed_for_predict(self, features):
         return {
             self.features: features,
@@ -132,3 +154,29 @@ class TransferModel(object):
             self.label_ids: label_ids,
             self.keep_prob: keep_prob,
         }
+
+
+class NumpyTransferModel(object):
+    """
+    NumpyTransferModel predicts as TransferModel does, from the weights exported by
+    TransferModel.export_weights, without TensorFlow.
+    """
+
+    def __init__(self, hidden_weights, hidden_biases, logits_weights, logits_biases):
+        self.hidden_weights = hidden_weights
+        self.hidden_biases = hidden_biases
+        self.logits_weights = logits_weights
+        self.logits_biases = logits_biases
+
+    @classmethod
+    def load(cls, path):
+        with tf.gfile.FastGFile(path, 'rb') as f:
+            weights = np.load(io.BytesIO(f.read()))
+            return cls(**{name: weights[name] for name in weights.files})
+
+    def predict(self, features):
+        # Both layers are fully_connected with the default relu, and dropout is off
+        hidden = np.maximum(np.dot(features, self.hidden_weights) + self.hidden_biases, 0)
+        logits = np.maximum(np.dot(hidden, self.logits_weights) + self.logits_biases, 0)
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
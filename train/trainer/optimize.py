@@ -0,0 +1,255 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import node_def_pb2
+from tensorflow.python.framework import graph_util, op_def_registry, tensor_util
+from tensorflow.python.tools import optimize_for_inference_lib
+
+from trainer.feature_extractor import (
+    BATCH_FEATURE_TENSOR_NAME, FeatureExtractor, RESIZED_DATA_TENSOR_NAME
+)
+
+logger = logging.getLogger(__name__)
+
+INPUT_NODE_NAME = RESIZED_DATA_TENSOR_NAME.split(':')[0]
+OUTPUT_NODE_NAME = BATCH_FEATURE_TENSOR_NAME.split(':')[0]
+
+
+def optimize_graph(graph_def, quantize=False, min_quantize_size=1024):
+    """The graph from the resized images to the features, for FeatureExtractor to serve.
+
+    DecodeJpeg and the resizing before ResizeBilinear are replaced by a placeholder of the same
+    name, the classification head after pool_3 is removed and the batch normalizations are
+    folded into the convolutions.
+    """
+    graph_def = optimize_for_inference_lib.optimize_for_inference(
+        graph_def, [INPUT_NODE_NAME], [OUTPUT_NODE_NAME], tf.float32.as_datatype_enum)
+    graph_def = fold_constants(graph_def, [OUTPUT_NODE_NAME])
+    if quantize:
+        graph_def = quantize_weights(graph_def, min_size=min_quantize_size)
+    return graph_def
+
+
+def fold_constants(graph_def, output_names):
+    """Replaces the ops computed only from constants by constants of their values."""
+    ops = op_def_registry.get_registered_ops()
+    nodes = {n.name: n for n in graph_def.node}
+
+    constant = {n.name for n in graph_def.node if n.op == 'Const'}
+    changed = True
+    while changed:
+        changed = False
+        for n in graph_def.node:
+            if (n.name in constant or n.op not in ops or ops[n.op].is_stateful or
+                    n.op == 'Placeholder' or not n.input):
+                continue
+            if all(not i.startswith('^') and _node_name(i) in constant for i in n.input):
+                constant.add(n.name)
+                changed = True
+
+    # The constants used by the rest of the graph, if only by their first outputs
+    folded, multiple = set(), set()
+    for n in graph_def.node:
+        if n.name in constant:
+            continue
+        for i in n.input:
+            name = _node_name(i)
+            if name in constant and nodes[name].op != 'Const':
+                (multiple if _output_index(i) else folded).add(name)
+    folded.update(name for name in output_names if name in constant)
+    folded -= multiple
+    if not folded:
+        return graph_def
+
+    folded = sorted(folded)
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        with tf.Session(graph=graph) as sess:
+            values = sess.run([name + ':0' for name in folded])
+
+    output = tf.GraphDef()
+    values = dict(zip(folded, values))
+    for n in graph_def.node:
+        if n.name in values:
+            output.node.extend([_const(n.name, values[n.name])])
+        else:
+            output.node.extend([n])
+    logger.info('Folded %d ops into constants.', len(folded))
+    return graph_util.extract_sub_graph(output, output_names)
+
+
+def quantize_weights(graph_def, min_size=1024):
+    """Stores the float constants of min_size elements or more in 8 bits, dequantized by ops.
+
+    Each is rounded to 256 levels between its min and max. The session folds them back to float
+    when it loads the graph, so it is the file which is smaller.
+    """
+    output = tf.GraphDef()
+    for n in graph_def.node:
+        if n.op != 'Const' or n.attr['dtype'].type != tf.float32.as_datatype_enum:
+            output.node.extend([n])
+            continue
+        value = tensor_util.MakeNdarray(n.attr['value'].tensor)
+        if value.size < min_size:
+            output.node.extend([n])
+            continue
+
+        low, high = float(value.min()), float(value.max())
+        scale = (high - low) / 255 or 1.0
+        quantized = np.round((value - low) / scale).astype(np.uint8)
+        output.node.extend([
+            _const(n.name + '/quantized', quantized),
+            _const(n.name + '/scale', np.float32(scale)),
+            _const(n.name + '/min', np.float32(low)),
+            _op('Cast', n.name + '/dequantized', [n.name + '/quantized'],
+                SrcT=tf.uint8, DstT=tf.float32),
+            _op('Mul', n.name + '/scaled', [n.name + '/dequantized', n.name + '/scale'],
+                T=tf.float32),
+            # The name of the constant, for the ops using it
+            _op('Add', n.name, [n.name + '/scaled', n.name + '/min'], T=tf.float32),
+        ])
+    return output
+
+
+def cosine_similarities(a, b):
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return (a * b).sum(axis=1) / np.maximum(norms, 1e-12)
+
+
+def compare(model_file, optimized_file, imgs, repeat=3):
+    """Features of imgs by both graphs with the load time and the latency per image of each."""
+    results = []
+    for path in [model_file, optimized_file]:
+        start = time.time()
+        with FeatureExtractor(path) as extractor:
+            load_time = time.time() - start
+            extractor.get_feature_vectors(imgs[:1])
+            latencies = []
+            for _ in range(repeat):
+                start = time.time()
+                features = extractor.get_feature_vectors(imgs)
+                latencies.append((time.time() - start) / len(imgs))
+        results.append((features, load_time, float(np.median(latencies))))
+    return results
+
+
+def load_images(image_dir, max_images=64):
+    paths = []
+    for root, _, files in os.walk(image_dir):
+        paths.extend(os.path.join(root, f) for f in sorted(files)
+                     if os.path.splitext(f)[1].lower() in ['.jpg', '.jpeg', '.png'])
+    return [cv2.imread(p) for p in sorted(paths)[:max_images]]
+
+
+def synthetic_images(n=16, seed=0):
+    # Candy-like ellipses on the table, for when no crops are given
+    rng = np.random.RandomState(seed)
+    imgs = []
+    for _ in range(n):
+        h, w = rng.randint(80, 200, size=2)
+        img = np.full((h, w, 3), 220, dtype=np.uint8)
+        color = tuple(int(c) for c in rng.randint(0, 256, size=3))
+        axes = (int(w * rng.uniform(0.25, 0.45)), int(h * rng.uniform(0.25, 0.45)))
+        cv2.ellipse(img, (w // 2, h // 2), axes, rng.randint(0, 180), 0, 360, color, -1)
+        imgs.append(cv2.GaussianBlur(img, (5, 5), 0))
+    return imgs
+
+
+def _node_name(tensor_name):
+    return tensor_name.lstrip('^').split(':')[0]
+
+
+def _output_index(tensor_name):
+    parts = tensor_name.split(':')
+    return int(parts[1]) if len(parts) > 1 else 0
+
+
+def _const(name, value):
+    node = node_def_pb2.NodeDef(op='Const', name=name)
+    node.attr['dtype'].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+    return node
+
+
+def _op(op, name, inputs, **types):
+    node = node_def_pb2.NodeDef(op=op, name=name, input=inputs)
+    for key, dtype in types.items():
+        node.attr[key].type = dtype.as_datatype_enum
+    return node
+
+
+def main(_):
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-7s %(levelname)-7s %(message)s'
+    )
+
+    parser = argparse.ArgumentParser(description='Optimize inception-v3 for FeatureExtractor.')
+    parser.add_argument('--model_file', type=str, required=True,
+                        help="classify_image_graph_def.pb")
+    parser.add_argument('--output_file', type=str, required=True)
+    parser.add_argument('--quantize', action='store_true',
+                        help="Store the weights in 8 bits.")
+    parser.add_argument('--min_cosine', type=float, default=0.99,
+                        help="Least cosine similarity of the features to the original ones.")
+    parser.add_argument('--image_dir', type=str, default=None,
+                        help="Directory of candy crops to check the features with.")
+
+    args = parser.parse_args()
+
+    imgs = load_images(args.image_dir) if args.image_dir else synthetic_images()
+    if not imgs:
+        logger.error('No images in %s.', args.image_dir)
+        return 1
+
+    with tf.gfile.FastGFile(args.model_file, 'rb') as f:
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(f.read())
+    optimized = optimize_graph(graph_def, quantize=args.quantize)
+    with tf.gfile.FastGFile(args.output_file, 'wb') as f:
+        f.write(optimized.SerializeToString())
+
+    (expected, load_time, latency), (actual, opt_load_time, opt_latency) = compare(
+        args.model_file, args.output_file, imgs)
+
+    cosines = cosine_similarities(expected, actual)
+    logger.info('Nodes: %d -> %d', len(graph_def.node), len(optimized.node))
+    logger.info('File: %d -> %d bytes', os.path.getsize(args.model_file),
+                os.path.getsize(args.output_file))
+    logger.info('Load time: %.2f -> %.2f s', load_time, opt_load_time)
+    logger.info('Latency per image: %.1f -> %.1f ms', 1000 * latency, 1000 * opt_latency)
+    logger.info('Cosine similarity of %d images: min %.5f, mean %.5f', len(imgs), cosines.min(),
+                cosines.mean())
+
+    if cosines.min() < args.min_cosine:
+        os.remove(args.output_file)
+        logger.error('Removed %s, as the cosine similarity is less than %s.', args.output_file,
+                     args.min_cosine)
+        return 1
+    logger.info('Wrote %s.', args.output_file)
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -179,6 +179,7 @@ class Trainer(object):
                     time.sleep(self._sleep_sec)
 
             self.model.saver.save(sess, checkpoint_path, global_step=self.model.global_step)
+            self.model.export_weights(sess, os.path.join(self.train_dir, model.WEIGHTS_FILE))
             summary_writer.close()
 
     def _needs_logging(self, loss_log):
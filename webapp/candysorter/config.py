@@ -40,8 +40,10 @@ class DefaultConfig(object):
     LOG_DIR   = os.path.join(PROJECT_ROOT, 'logs')
     LOG_LEVEL = logging.INFO
 
-    CLASS_TEXT_ANALYZER = 'candysorter.models.texts.TextAnalyzer'
-    CLASS_IMAGE_CAPTURE = 'candysorter.models.images.capture.ImageCapture'
+    CLASS_TEXT_ANALYZER  = 'candysorter.models.texts.TextAnalyzer'
+    CLASS_IMAGE_CAPTURE  = 'candysorter.models.images.capture.ImageCapture'
+    # or 'candysorter.models.images.detect.BackgroundCandyDetector'
+    CLASS_CANDY_DETECTOR = 'candysorter.models.images.detect.CandyDetector'
 
     WORD2VEC_MODEL_FILES = {
         'en': {
@@ -56,6 +58,20 @@ class DefaultConfig(object):
     CLASSIFIER_MODEL_DIR         = os.path.join(MODEL_DIR, 'classifier')
     CLASSIFIER_MODEL_DIR_INITIAL = os.path.join(MODEL_DIR, 'classifier_initial')
     INCEPTION_MODEL_FILE         = os.path.join(MODEL_DIR, 'classify_image_graph_def.pb')
+    # Threads of the TensorFlow session extracting features, 0 lets TensorFlow choose
+    INCEPTION_INTRA_OP_THREADS   = 0
+    INCEPTION_INTER_OP_THREADS   = 0
+    # Features of the crops kept in memory up to this size (bytes, 0 disables). Crops are
+    # matched exactly, or with a tolerance, by at most that many bits of their 64-bit hashes.
+    FEATURE_CACHE_MAX_BYTES      = 32 * 1024 * 1024
+    FEATURE_CACHE_HASH_TOLERANCE = None
+    # Processes extracting the features, 0 extracts them in the webapp process. Crops are passed
+    # through a buffer of shared memory of each process. Every webapp process starts its own, so
+    # run uWSGI with processes = 1 (setup/nginx_config_example/webapp.ini) when this is > 0:
+    # more would load inception-v3 processes x FEATURE_POOL_PROCESSES times, and workers forked
+    # from a master without lazy-apps would share the pipes of one pool.
+    FEATURE_POOL_PROCESSES       = 0
+    FEATURE_POOL_BUFFER_BYTES    = 16 * 1024 * 1024
 
     POS_WEIGHTS = {
         language.PartOfSpeech.ADJECTIVE: 1.0,
@@ -76,6 +92,27 @@ class DefaultConfig(object):
     CANDY_DETECTOR_SURE_FG_THRES    = 10
     CANDY_DETECTOR_RESTORE_FG_THRES = 0.0
     CANDY_DETECTOR_BOX_DIM_THRES    = 50
+    # None keeps the variable-size crop, e.g. 299 crops directly to the inception input size
+    CANDY_DETECTOR_CROP_SIZE        = None
+    # < 1.0 segments on the image downscaled by this factor and refines candies at full size
+    CANDY_DETECTOR_SCALE            = 1.0
+    # > 1 segments overlapping tiles on a thread pool of this size. The same candies as 1 only
+    # with an absolute CANDY_DETECTOR_SURE_FG_THRES (> 1), a relative one is relative to each tile
+    CANDY_DETECTOR_WORKERS          = 1
+    CANDY_DETECTOR_TILE_OVERLAP     = 200
+    # Blobs whose area / convex hull area is at least this skip the watershed, None disables it.
+    # Enable it per environment once detector_tune shows the same accuracy, e.g. 0.95
+    CANDY_DETECTOR_SOLIDITY_THRES   = None
+    # Candies of a label of several fragments are its largest one rather than the first one found,
+    # with the crop masked by it. Recall on the synthetic scenes of tests/benchmarks: 0.59 -> 0.73
+    CANDY_DETECTOR_LARGEST_FRAGMENT = False
+    # Only pixels within this distance (px) of the pickable area are segmented
+    CANDY_DETECTOR_REACH_MARGIN     = 150
+    # Logs the time of each detection stage and the number of components and candies
+    CANDY_DETECTOR_LOG_METRICS      = False
+    # BackgroundCandyDetector: threshold of the difference and frames to learn the background
+    CANDY_DETECTOR_DIFF_THRES       = 30
+    CANDY_DETECTOR_BG_FRAMES        = 5
 
     IMAGE_CAPTURE_DEVICE      = 0
     IMAGE_CAPTURE_WIDTH       = 1920
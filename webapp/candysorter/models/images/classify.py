@@ -17,22 +17,79 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 import os
+import threading
 
 import tensorflow as tf
 
 from trainer.feature_extractor import FeatureExtractor
-from trainer.model import ModelParams, TransferModel
+from trainer.model import ModelParams, NumpyTransferModel, TransferModel, WEIGHTS_FILE
+
+from candysorter.models.images.features import FeatureCache, FeaturePool
 
 logger = logging.getLogger(__name__)
 
 
+class TransferPredictor(object):
+    """The transfer model restored from a checkpoint once, in a session of its own."""
+
+    def __init__(self, params, checkpoint_path):
+        self.params = params
+        self.checkpoint_path = checkpoint_path
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.model = TransferModel(features_size=params.features_size,
+                                       num_classes=len(params.labels),
+                                       for_predict=True,
+                                       hidden_size=params.hidden_size)
+            self.sess = tf.Session(graph=self.graph)
+            self.model.restore(self.sess, checkpoint_path)
+        self.graph.finalize()
+        # The number of predictions in progress, which close() waits for
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def predict(self, features):
+        with self._cond:
+            if self.sess is None:
+                raise RuntimeError('TransferPredictor is already closed.')
+            self._running += 1
+        try:
+            return self.model.predict(self.sess, features)
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def close(self):
+        # After the predictions in progress
+        with self._cond:
+            while self._running:
+                self._cond.wait()
+            if self.sess is not None:
+                self.sess.close()
+                self.sess = None
+
+
 class CandyClassifier(object):
-    def __init__(self, checkpoint_dir, params_file, inception_model_file):
+    def __init__(self, checkpoint_dir, params_file, inception_model_file, intra_op_threads=0,
+                 inter_op_threads=0, feature_cache=None, feature_processes=0,
+                 feature_buffer_bytes=16 * 1024 * 1024):
         self.inception_model = None
-        self.model = None
+        self.feature_cache = feature_cache or FeatureCache(max_bytes=0)
+        self.feature_processes = feature_processes
+        self.feature_buffer_bytes = feature_buffer_bytes
         self.checkpoint_dir = checkpoint_dir
         self.params_file = params_file
+        self.weights_file = os.path.join(checkpoint_dir, WEIGHTS_FILE)
         self.inception_model_file = inception_model_file
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+
+        # The TransferPredictor with the checkpoint it is of, replaced together
+        self._transfer = (None, None)
+        # The modification time of the inception model file when it was loaded
+        self._inception_key = None
+        self._lock = threading.Lock()
 
     @classmethod
     def from_config(cls, config):
@@ -40,34 +97,131 @@ class CandyClassifier(object):
         return cls(
             checkpoint_dir=checkpoint_dir,
             params_file=os.path.join(checkpoint_dir, 'params.json'),
-            inception_model_file=config.INCEPTION_MODEL_FILE
+            inception_model_file=config.INCEPTION_MODEL_FILE,
+            intra_op_threads=config.INCEPTION_INTRA_OP_THREADS,
+            inter_op_threads=config.INCEPTION_INTER_OP_THREADS,
+            feature_cache=FeatureCache.from_config(config),
+            feature_processes=config.FEATURE_POOL_PROCESSES,
+            feature_buffer_bytes=config.FEATURE_POOL_BUFFER_BYTES
         )
 
     def init(self):
-        self._load_inception_model()
-        self._load_transfer_model()
+        with self._lock:
+            self._load_inception_model()
+            self._load_transfer_model(self._checkpoint_key())
 
     def reload(self):
-        tf.reset_default_graph()
-        self._load_transfer_model()
+        with self._lock:
+            # Feature workers are started again only if the model file has been replaced or one
+            # of them has exited, as forking them is slow and the process may be running
+            # TensorFlow by now
+            if (_mtime(self.inception_model_file) != self._inception_key or
+                    not getattr(self.inception_model, 'alive', True)):
+                self._load_inception_model()
+            self._load_transfer_model(self._checkpoint_key())
+
+    def close(self):
+        with self._lock:
+            if self.inception_model is not None:
+                self.inception_model.close()
+                self.inception_model = None
+            _, predictor = self._transfer
+            self._transfer = (None, None)
+            if isinstance(predictor, TransferPredictor):
+                predictor.close()
 
     def _load_inception_model(self):
         logger.info('Loading inception model...')
-        self.inception_model = FeatureExtractor(self.inception_model_file)
+        previous = self.inception_model
+        key = _mtime(self.inception_model_file)
+        if self.feature_processes > 0:
+            self.inception_model = FeaturePool(self.inception_model_file,
+                                               processes=self.feature_processes,
+                                               buffer_bytes=self.feature_buffer_bytes,
+                                               intra_op_threads=self.intra_op_threads,
+                                               inter_op_threads=self.inter_op_threads)
+        else:
+            self.inception_model = FeatureExtractor(self.inception_model_file,
+                                                    intra_op_threads=self.intra_op_threads,
+                                                    inter_op_threads=self.inter_op_threads)
+        self._inception_key = key
+        self.feature_cache.set_backbone(self.inception_model_file)
+        if previous is not None:
+            # After the extractions in progress
+            previous.close()
         logger.info('Finished loading inception model.')
 
-    def _load_transfer_model(self):
+    def _load_transfer_model(self, key):
         logger.info('Loading transfer model...')
-        with tf.gfile.FastGFile(self.params_file, 'r') as f:
-            params = ModelParams.from_json(f.read())
-        self.model = TransferModel.from_model_params(params)
-        logger.info('Finished loading transfer model.')
+        if os.path.isfile(self.weights_file):
+            predictor = NumpyTransferModel.load(self.weights_file)
+            source = self.weights_file
+        else:
+            # Checkpoints without the exported weights
+            with tf.gfile.FastGFile(self.params_file, 'r') as f:
+                params = ModelParams.from_json(f.read())
+            predictor = TransferPredictor(params, self._checkpoint_path())
+            source = predictor.checkpoint_path
+        _, previous = self._transfer
+        self._transfer = (key, predictor)
+        if isinstance(previous, TransferPredictor):
+            # After the predictions in progress, and the ones starting now find the new one
+            previous.close()
+        logger.info('Finished loading transfer model. source=%s', source)
+
+    def _transfer_predictor(self):
+        # Loaded again only if the checkpoint directory has changed
+        key = self._checkpoint_key()
+        if self._transfer[0] != key:
+            with self._lock:
+                if self._transfer[0] != key:
+                    self._load_transfer_model(key)
+        return self._transfer[1]
+
+    def _predict(self, features):
+        predictor = self._transfer_predictor()
+        try:
+            return predictor.predict(features)
+        except RuntimeError:
+            # Closed since, as it has been replaced
+            if self._transfer[1] is predictor:
+                raise
+            return self._transfer_predictor().predict(features)
+
+    def _checkpoint_key(self):
+        # The directory may be a symlink replaced by a new one
+        checkpoint_dir = os.path.realpath(self.checkpoint_dir)
+        return (checkpoint_dir,) + tuple(
+            _mtime(os.path.join(checkpoint_dir, name)) for name in ['checkpoint', WEIGHTS_FILE]
+        )
 
     def classify(self, img_bgr):
-        features = self.inception_model.get_feature_vector(img_bgr)
+        return self.classify_batch([img_bgr])[0]
+
+    def classify_batch(self, imgs_bgr):
+        # Probabilities of the labels for each image, as an N x labels matrix
+        features = self.feature_cache.get_feature_vectors(
+            imgs_bgr, self.inception_model.get_feature_vectors)
+        return self._predict(features)
+
+    def get_feature_vectors_from_files(self, image_paths):
+        # For CandyTrainer, with the inception model loaded at the time
+        return self.inception_model.get_feature_vectors_from_files(image_paths)
+
+    def warm_up(self, imgs_bgr):
+        # Not through the feature cache, which would skip inception for the same images
+        features = self.inception_model.get_feature_vectors(imgs_bgr)
+        return self._predict(features)
+
+    def _checkpoint_path(self):
         ckpt = tf.train.get_checkpoint_state(self.checkpoint_dir)
         if ckpt is None:
             raise IOError('Checkpoints not found.')
-        checkpoint_path = ckpt.model_checkpoint_path
-        result = self.model.restore_and_predict(features, checkpoint_path)
-        return result[0]
+        return ckpt.model_checkpoint_path
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
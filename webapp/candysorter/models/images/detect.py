@@ -15,23 +15,258 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
 import logging
+from multiprocessing.pool import ThreadPool
+import numbers
+import threading
+from timeit import default_timer
 
 import cv2
 from google.cloud import vision
 import numpy as np
+from scipy import ndimage
+
+from candysorter.models.images import morphology
+from candysorter.models.images.filter import pickable_at
 
 logger = logging.getLogger(__name__)
 
-vision_client = vision.Client()
+vision_client = None
+
+_KERNEL = np.ones((3, 3), np.uint8)
+_KERNEL_LAPLACIAN_3X3 = np.float32([
+    [1, 1, 1],
+    [1, -8, 1],
+    [1, 1, 1]
+])
+_KERNEL_GAUSSIAN = np.float32([
+    [1, 2, 1],
+    [2, 4, 2],
+    [1, 2, 1]
+]) / 16
+_KERNEL_LAPLACIAN_5X5 = np.float32([
+    [-1, -3, -4, -3, -1],
+    [-3, 0, 6, 0, -3],
+    [-4, 6, 20, 6, -4],
+    [-3, 0, 6, 0, -3],
+    [-1, -3, -4, -3, -1]
+])
 
 
 class Candy(object):
-    def __init__(self, box_coords, box_dims, box_centroid, cropped_img):
+    def __init__(self, box_coords, box_dims, box_centroid, cropped_img=None, crop=None):
         self.box_coords = box_coords
         self.box_dims = box_dims
         self.box_centroid = box_centroid
-        self.cropped_img = cropped_img
+        self._cropped_img = cropped_img
+        self._crop = crop
+
+    @property
+    def cropped_img(self):
+        # Cropped on first access, so that candies excluded before are never cropped.
+        # The detected image must not be modified until then.
+        if self._cropped_img is None and self._crop is not None:
+            self._cropped_img = self._crop()
+            self._crop = None
+        return self._cropped_img
+
+
+class CandySet(object):
+    """Detected candies, with their boxes as arrays of all candies.
+
+    Iterating and indexing with an int give Candy objects as a list of them would. Indexing with
+    a boolean mask or an array of indices gives another CandySet. The images are cropped on first
+    access and shared with the CandySets taken from this one.
+    """
+
+    def __init__(self, box_coords, box_dims, box_centroids, crops):
+        self.box_coords = box_coords.reshape(-1, 4, 2)
+        self.box_dims = box_dims.reshape(-1, 2)
+        self.box_centroids = box_centroids.reshape(-1, 2)
+        self._crops = crops
+
+    @classmethod
+    def of(cls, candies):
+        if isinstance(candies, cls):
+            return candies
+        candies = list(candies)
+        return cls(box_coords=np.float32([c.box_coords for c in candies]),
+                   box_dims=np.float64([c.box_dims for c in candies]),
+                   box_centroids=np.int_([c.box_centroid for c in candies]),
+                   crops=[_Crop(c._cropped_img, c._crop) for c in candies])
+
+    def __len__(self):
+        return len(self._crops)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, index):
+        if isinstance(index, numbers.Integral):
+            return Candy(box_coords=tuple(tuple(p) for p in self.box_coords[index]),
+                         box_dims=tuple(self.box_dims[index].tolist()),
+                         box_centroid=tuple(self.box_centroids[index].tolist()),
+                         crop=self._crops[index])
+        index = np.arange(len(self))[index]
+        return CandySet(box_coords=self.box_coords[index],
+                        box_dims=self.box_dims[index],
+                        box_centroids=self.box_centroids[index],
+                        crops=[self._crops[i] for i in index])
+
+    def __add__(self, other):
+        other = CandySet.of(other)
+        return CandySet(box_coords=np.concatenate([self.box_coords, other.box_coords]),
+                        box_dims=np.concatenate([self.box_dims, other.box_dims]),
+                        box_centroids=np.concatenate([self.box_centroids, other.box_centroids]),
+                        crops=self._crops + other._crops)
+
+    def __repr__(self):
+        return 'CandySet({})'.format(self.box_centroids.tolist())
+
+    @property
+    def boxes(self):
+        """Upright bounding boxes as an (n, 4) array of x1, y1, x2, y2."""
+        return np.concatenate([np.floor(self.box_coords.min(axis=1)),
+                               np.ceil(self.box_coords.max(axis=1))], axis=1).astype(int)
+
+    def coordinates(self, calibrator):
+        """Robot coordinates of the centroids as an (n, 2) array."""
+        xs, ys = self.box_centroids.T
+        return np.stack(calibrator.get_coordinate(xs, ys), axis=1).reshape(-1, 2)
+
+    def pickable(self, calibrator):
+        """Boolean mask of the candies whose centroid the arm can reach."""
+        return pickable_at(calibrator, self.box_centroids)
+
+    def sorted_by(self, keys):
+        """Candies in the stable ascending order of keys, one for each candy."""
+        return self[np.argsort(keys, kind='mergesort')]
+
+    def to_json(self):
+        return [dict(box=box, dims=dims, centroid=centroid)
+                for box, dims, centroid in zip(self.box_coords.astype(int).tolist(),
+                                               self.box_dims.tolist(),
+                                               self.box_centroids.tolist())]
+
+
+class _Crop(object):
+    # Crops an image once for all the Candy objects of the same candy
+    def __init__(self, img, crop):
+        self.img = img
+        self.crop = crop
+
+    def __call__(self):
+        if self.img is None and self.crop is not None:
+            self.img = self.crop()
+            self.crop = None
+        return self.img
+
+
+class DetectorWorkspace(object):
+    """Preallocated buffers for detecting candies in images of the same shape."""
+
+    def __init__(self, shape):
+        self.shape = shape
+
+        self.gray = np.empty(shape, dtype=np.uint8)
+        self.binarized = np.empty(shape, dtype=np.uint8)
+        self.edge = np.empty(shape, dtype=np.uint8)
+        self.smoothed = np.empty(shape, dtype=np.uint8)
+        self.closed = np.empty(shape, dtype=np.uint8)
+        self.half_opened = np.empty(shape, dtype=np.uint8)
+        self.eroded = np.empty(shape, dtype=np.uint8)
+        self.bg = np.empty(shape, dtype=np.uint8)
+        self.sure_bg = np.empty(shape, dtype=np.uint8)
+        self.fg = np.empty(shape, dtype=np.uint8)
+        self.sure_fg = np.empty(shape, dtype=np.uint8)
+        self.mask = np.empty(shape, dtype=np.bool_)
+        self.dist = np.empty(shape, dtype=np.float32)
+        self.markers = np.empty(shape, dtype=np.int32)
+
+    def window(self, shape):
+        """The buffers cut to shape, for a window of the images of this workspace."""
+        ws = DetectorWorkspace.__new__(DetectorWorkspace)
+        ws.shape = shape
+        for name, buf in vars(self).items():
+            if isinstance(buf, np.ndarray):
+                setattr(ws, name, buf[:shape[0], :shape[1]])
+        return ws
+
+
+class DetectorMetrics(object):
+    """Wall time of each stage and counts of a single detect() call."""
+
+    enabled = True
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, other):
+        for name, seconds in other.stages.items():
+            self.add(name, seconds)
+        for name, n in other.counts.items():
+            self.count(name, n)
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def __str__(self):
+        return ', '.join(['{}={:.1f}ms'.format(name, seconds * 1000)
+                          for name, seconds in self.stages.items()] +
+                         ['{}={}'.format(name, n) for name, n in self.counts.items()])
+
+
+class _Stage(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = default_timer()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add(self.name, default_timer() - self.start)
+
+
+class _NullMetrics(object):
+    # Does nothing, so that a detector without metrics_hook pays almost nothing for the stages
+
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, name, n):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+class _NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_METRICS = _NullMetrics()
+_NULL_STAGE = _NullStage()
 
 
 class CandyDetector(object):
@@ -49,7 +284,14 @@ class CandyDetector(object):
                  bg_size_filter=2000,
                  sure_fg_thres=0.5,
                  restore_fg_thres=0.0,
-                 box_dim_thres=50):
+                 box_dim_thres=50,
+                 crop_size=None,
+                 scale=1.0,
+                 workers=1,
+                 tile_overlap=200,
+                 solidity_thres=None,
+                 largest_fragment=False,
+                 metrics_hook=None):
         self.histgram_band = histgram_band
         self.histgram_thres = histgram_thres
 
@@ -67,6 +309,23 @@ class CandyDetector(object):
         self.sure_fg_thres = sure_fg_thres
         self.restore_fg_thres = restore_fg_thres
         self.box_dim_thres = box_dim_thres
+        self.crop_size = crop_size
+        self.scale = scale
+        self.workers = workers
+        self.tile_overlap = tile_overlap
+        self.solidity_thres = solidity_thres
+        self.largest_fragment = largest_fragment
+        # uint8 mask of the pixels to segment in images of its shape, see set_reach()
+        self.reach_mask = None
+        # Called with the DetectorMetrics of each detect() call
+        self.metrics_hook = metrics_hook
+
+        # Free workspaces by shape, shared by the threads
+        self._workspaces = {}
+        self._workspaces_lock = threading.Lock()
+        self._coarse_detector = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     @classmethod
     def from_config(cls, config):
@@ -83,142 +342,631 @@ class CandyDetector(object):
                    bg_size_filter=config.CANDY_DETECTOR_BG_SIZE_FILTER,
                    sure_fg_thres=config.CANDY_DETECTOR_SURE_FG_THRES,
                    restore_fg_thres=config.CANDY_DETECTOR_RESTORE_FG_THRES,
-                   box_dim_thres=config.CANDY_DETECTOR_BOX_DIM_THRES)
+                   box_dim_thres=config.CANDY_DETECTOR_BOX_DIM_THRES,
+                   crop_size=config.CANDY_DETECTOR_CROP_SIZE,
+                   scale=config.CANDY_DETECTOR_SCALE,
+                   workers=config.CANDY_DETECTOR_WORKERS,
+                   tile_overlap=config.CANDY_DETECTOR_TILE_OVERLAP,
+                   solidity_thres=config.CANDY_DETECTOR_SOLIDITY_THRES,
+                   largest_fragment=config.CANDY_DETECTOR_LARGEST_FRAGMENT,
+                   metrics_hook=_log_metrics if config.CANDY_DETECTOR_LOG_METRICS else None)
+
+    def set_reach(self, mask, margin=0):
+        """Segments only the pixels within margin of mask in images of the shape of mask.
+
+        The margin keeps candies whose centroid is in mask entirely inside of the segmented area.
+        """
+        self.reach_mask = morphology.dilate(np.uint8(mask) * 255, margin)
+
+    def close(self):
+        # The thread pool of the tiles, e.g. at exit
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
 
     def detect(self, img):
-        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.metrics_hook is None:
+            return CandySet.of(self._detect(img, _NO_METRICS))
+
+        metrics = DetectorMetrics()
+        candies = CandySet.of(self._detect(img, metrics))
+        metrics.count('candies', len(candies))
+        self.metrics_hook(metrics)
+        return candies
+
+    def _detect(self, img, metrics):
+        with self._workspace(img.shape[:2]) as ws:
+            # Check object
+            with metrics.stage('histogram'):
+                img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=ws.gray)
+                histr = cv2.calcHist([img_gray], [0], None, [256], [0, 256])
+                histr = histr / histr.sum()
+            if histr[self.histgram_band[0]:self.histgram_band[1]].sum() <= self.histgram_thres:
+                return []
+
+            if self.scale < 1.0:
+                return self._detect_pyramid(img, img_gray, ws, metrics)
+
+            if self.workers > 1:
+                return self._detect_tiled(img, img_gray, metrics)
+
+            markers = self._segment(img_gray, ws, metrics=metrics)
+            return self._candies_of(img, markers, metrics=metrics)
+
+    def detect_stream(self, frames, diff_thres=30, min_diff_area=20, area_thres=0.2, pad=100):
+        """Detects candies in consecutive frames of a static table.
+
+        Only the regions changed from the frame they were last segmented in are segmented
+        again, and the previous CandySet is yielded as is if nothing changed. If the changed
+        area is larger than area_thres of the frame, the whole frame is detected again.
+        """
+        # Each pixel as it was when last segmented, so that slow drifts add up
+        ref_gray = None
+        candies = CandySet.of([])
+        for img in frames:
+            img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            if ref_gray is None or ref_gray.shape != img_gray.shape:
+                candies = self.detect(img)
+                ref_gray = img_gray
+            else:
+                boxes, area = _changed_boxes(ref_gray, img_gray, diff_thres, min_diff_area)
+                if area > area_thres * img_gray.size:
+                    candies = self.detect(img)
+                    ref_gray = img_gray
+                elif boxes:
+                    candies, rois = self._redetect(img, img_gray, candies, boxes, pad)
+                    for x1, y1, x2, y2 in rois:
+                        ref_gray[y1:y2, x1:x2] = img_gray[y1:y2, x1:x2]
+            yield candies
 
-        # Check object
-        histr = cv2.calcHist([img_gray], [0], None, [256], [0, 256])
-        histr = histr / histr.sum()
-        if histr[self.histgram_band[0]:self.histgram_band[1]].sum() <= self.histgram_thres:
-            return []
+    def _redetect(self, img, img_gray, candies, boxes, pad):
+        # Grow the changed boxes until every candy is either inside or outside of them. Returns
+        # the candies and the grown boxes, in which they are of img now.
+        candy_boxes = [tuple(b) for b in candies.boxes.tolist()]
+        rois = _merge_boxes(boxes)
+        while True:
+            grown = _merge_boxes([
+                _union_of([roi] + [b for b in candy_boxes if _intersects(b, roi)])
+                for roi in rois
+            ])
+            if grown == rois:
+                break
+            rois = grown
+
+        h, w = img_gray.shape
+        kept = np.array([not any(_intersects(b, roi) for roi in rois) for b in candy_boxes],
+                        dtype=bool)
+        redetected = []
+        for x1, y1, x2, y2 in rois:
+            wx1, wy1 = max(x1 - pad, 0), max(y1 - pad, 0)
+            wx2, wy2 = min(x2 + pad, w), min(y2 + pad, h)
+            markers = self._segment(img_gray[wy1:wy2, wx1:wx2], offset=(wy1, wx1), shape=(h, w))
+            for c in self._candies_of(img, markers, offset=(wy1, wx1)):
+                cx, cy = c.box_centroid
+                if x1 <= cx < x2 and y1 <= cy < y2:
+                    redetected.append(c)
+        return candies[kept] + redetected, rois
+
+    def _candies_of(self, img, markers, offset=(0, 0), metrics=_NO_METRICS):
+        # markers may be of a window at offset in img
+        oy, ox = offset
+        candies = []
+        for i, window, mask in _regions_of(markers, start_label=2):
+            metrics.count('components', 1)
+            window = (slice(window[0].start + oy, window[0].stop + oy),
+                      slice(window[1].start + ox, window[1].stop + ox))
+            _, _contours, _ = cv2.findContours(np.uint8(mask), cv2.RETR_EXTERNAL,
+                                               cv2.CHAIN_APPROX_SIMPLE,
+                                               offset=(window[1].start, window[0].start))
+            contour = _contours[0]
+            if self.largest_fragment and len(_contours) > 1:
+                # Keep only the largest fragment of the label, e.g. when a label also got the
+                # pixels of a region whose seed is out of the window
+                contour = max(_contours, key=cv2.contourArea)
+                fragment = np.zeros(mask.shape, dtype=np.uint8)
+                cv2.drawContours(fragment, [contour], -1, 1, -1,
+                                 offset=(-window[1].start, -window[0].start))
+                mask &= fragment.view(np.bool_)
+            candy = self._candy_of(img, window, mask, contour)
+            if candy is not None:
+                candies.append(candy)
+        return candies
+
+    def _detect_tiled(self, img, img_gray, metrics=_NO_METRICS):
+        # Each tile owns the candies whose centroid is in its core. The window around the core
+        # is segmented, so tile_overlap has to be larger than a candy. A relative sure_fg_thres
+        # is relative to the distances in the window, so it may give other seeds than the image.
+        shape = img_gray.shape
+
+        def _detect_tile(tile):
+            (y1, x1, y2, x2), window = tile
+            # Tiles run concurrently, so each of them has its own metrics. Their times add up
+            # to the work of all tiles rather than the wall time.
+            tile_metrics = DetectorMetrics() if metrics.enabled else _NO_METRICS
+            with self._workspace(img_gray[window].shape) as ws:
+                markers = self._segment(img_gray[window], ws,
+                                        offset=(window[0].start, window[1].start), shape=shape,
+                                        metrics=tile_metrics)
+                candies = self._candies_of(img, markers,
+                                           offset=(window[0].start, window[1].start),
+                                           metrics=tile_metrics)
+            return tile_metrics, [c for c in candies
+                                  if x1 <= c.box_centroid[0] < x2 and y1 <= c.box_centroid[1] < y2]
+
+        with self._pool_lock:
+            # Concurrent requests share one pool
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            pool = self._pool
+        tiles = _tiles_of(shape, self.workers, self.tile_overlap)
+        candies = []
+        for tile_metrics, tile_candies in pool.map(_detect_tile, tiles):
+            metrics.merge(tile_metrics)
+            candies.extend(tile_candies)
+        return candies
+
+    def _detect_pyramid(self, img, img_gray, full_ws, metrics=_NO_METRICS):
+        # Segment on the downscaled image
+        with metrics.stage('downscale'):
+            small = cv2.resize(img_gray, None, fx=self.scale, fy=self.scale,
+                               interpolation=cv2.INTER_AREA)
+        coarse = self._coarse()
+        with coarse._workspace(small.shape) as coarse_ws:
+            markers = coarse._segment(small, coarse_ws, metrics=metrics)
+
+            # Refine each candidate at full resolution only inside its ROI, in the buffers of the
+            # full resolution workspace except for its gray image
+            h, w = img_gray.shape
+            candies = []
+            for i, window, _ in _regions_of(markers, start_label=2):
+                metrics.count('components', 1)
+                ys = slice(max(window[0].start - 2, 0), window[0].stop + 2)
+                xs = slice(max(window[1].start - 2, 0), window[1].stop + 2)
+                y1, y2 = int(ys.start / self.scale), min(int(np.ceil(ys.stop / self.scale)), h)
+                x1, x2 = int(xs.start / self.scale), min(int(np.ceil(xs.stop / self.scale)), w)
+                roi = (slice(y1, y2), slice(x1, x2))
+
+                with metrics.stage('refine'):
+                    labels = cv2.resize(markers[ys, xs], (x2 - x1, y2 - y1),
+                                        interpolation=cv2.INTER_NEAREST)
+
+                    ws = full_ws.window((y2 - y1, x2 - x1))
+                    binarized = self._binarize(img_gray[roi], ws)
+                    _fill_margin(binarized, self.margin, offset=(y1, x1), shape=(h, w))
+                    self._mask_unreachable(binarized, offset=(y1, x1), shape=(h, w))
+                    closed = morphology.closing(binarized, self.closing_iter, dst=ws.closed)
+                    _, contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL,
+                                                      cv2.CHAIN_APPROX_SIMPLE)
+                    cv2.drawContours(closed, contours, -1, 255, -1)
+                    half_opened = morphology.erode(closed, self.opening_iter, dst=ws.half_opened)
+                    bg = morphology.dilate(half_opened, self.opening_iter + self.dilate_iter,
+                                           dst=ws.bg)
+
+                    mask = (bg > 0) & (labels == i)
+                    _, _contours, _ = cv2.findContours(np.uint8(mask), cv2.RETR_EXTERNAL,
+                                                       cv2.CHAIN_APPROX_SIMPLE, offset=(x1, y1))
+                if not _contours:
+                    continue
+                candy = self._candy_of(img, roi, mask, max(_contours, key=cv2.contourArea))
+                if candy is not None:
+                    candies.append(candy)
+
+            return candies
+
+    @contextmanager
+    def _workspace(self, shape):
+        # Checked out for one detection, so that concurrent ones never share buffers. Returned
+        # to the pool of all threads, so that requests reuse the ones of the warm-up.
+        with self._workspaces_lock:
+            free = self._workspaces.setdefault(shape, [])
+            ws = free.pop() if free else None
+        if ws is None:
+            ws = DetectorWorkspace(shape)
+        try:
+            yield ws
+        finally:
+            with self._workspaces_lock:
+                self._workspaces[shape].append(ws)
+
+    def _coarse(self):
+        if (self._coarse_detector is None or self._coarse_detector[0] != self.scale or
+                self._coarse_detector[1] is not self.reach_mask):
+            coarse = self._scaled(self.scale)
+            if self.reach_mask is not None:
+                coarse.reach_mask = cv2.resize(self.reach_mask, None, fx=self.scale,
+                                               fy=self.scale, interpolation=cv2.INTER_NEAREST)
+            self._coarse_detector = (self.scale, self.reach_mask, coarse)
+        return self._coarse_detector[2]
+
+    def _scaled(self, scale):
+        # Detector for segmenting an image downscaled by scale
+        def _iter(n):
+            return max(int(round(n * scale)), 1) if n > 0 else 0
+
+        sure_fg_thres = self.sure_fg_thres
+        if sure_fg_thres > 1.0:
+            # Keep the threshold absolute
+            sure_fg_thres = max(sure_fg_thres * scale, np.nextafter(1.0, 2.0))
+
+        return CandyDetector(histgram_band=self.histgram_band,
+                             histgram_thres=self.histgram_thres,
+                             bin_thres=self.bin_thres,
+                             edge3_thres=self.edge3_thres,
+                             edge5_thres=self.edge5_thres,
+                             margin=tuple(int(round(m * scale)) for m in self.margin),
+                             closing_iter=_iter(self.closing_iter),
+                             opening_iter=_iter(self.opening_iter),
+                             erode_iter=_iter(self.erode_iter),
+                             dilate_iter=_iter(self.dilate_iter),
+                             bg_size_filter=self.bg_size_filter * scale ** 2,
+                             sure_fg_thres=sure_fg_thres,
+                             restore_fg_thres=self.restore_fg_thres,
+                             box_dim_thres=self.box_dim_thres * scale,
+                             crop_size=self.crop_size,
+                             solidity_thres=self.solidity_thres,
+                             largest_fragment=self.largest_fragment)
+
+    def _binarize(self, img_gray, ws=None, metrics=_NO_METRICS):
+        if ws is None:
+            ws = DetectorWorkspace(img_gray.shape)
 
         # Binarize
-        _, binarized = cv2.threshold(img_gray, self.bin_thres, 255, cv2.THRESH_BINARY_INV)
+        with metrics.stage('binarize'):
+            cv2.threshold(img_gray, self.bin_thres, 255, cv2.THRESH_BINARY_INV,
+                          dst=ws.binarized)
 
         # Edge
-        kernel_laplacian_3x3 = np.float32([
-            [1, 1, 1],
-            [1, -8, 1],
-            [1, 1, 1]
-        ])
-        kernel_gaussian = np.float32([
-            [1, 2, 1],
-            [2, 4, 2],
-            [1, 2, 1]
-        ]) / 16
-        kernel_laplacian_5x5 = np.float32([
-            [-1, -3, -4, -3, -1],
-            [-3, 0, 6, 0, -3],
-            [-4, 6, 20, 6, -4],
-            [-3, 0, 6, 0, -3],
-            [-1, -3, -4, -3, -1]
-        ])
-
-        edge3 = 255 - cv2.filter2D(img_gray, -1, kernel_laplacian_3x3)
-        edge3 = cv2.filter2D(edge3, -1, kernel_gaussian)
-        _, binarized_edge3 = cv2.threshold(edge3, self.edge3_thres, 255, cv2.THRESH_BINARY_INV)
-
-        edge5 = 255 - cv2.filter2D(img_gray, -1, kernel_laplacian_5x5)
-        edge5 = cv2.filter2D(edge5, -1, kernel_gaussian)
-        _, binarized_edge5 = cv2.threshold(edge5, self.edge5_thres, 255, cv2.THRESH_BINARY_INV)
-
-        binarized_edge = cv2.bitwise_or(binarized_edge3, binarized_edge5)
-        binarized = cv2.bitwise_or(binarized, binarized_edge)
-
-        # Fill the margin with black
-        binarized[:self.margin[0], :] = 0
-        binarized[-self.margin[0]:, :] = 0
-        binarized[:, :self.margin[1]] = 0
-        binarized[:, -self.margin[1]:] = 0
+        with metrics.stage('edge3'):
+            cv2.filter2D(img_gray, -1, _KERNEL_LAPLACIAN_3X3, dst=ws.edge)
+            cv2.bitwise_not(ws.edge, dst=ws.edge)
+            cv2.filter2D(ws.edge, -1, _KERNEL_GAUSSIAN, dst=ws.smoothed)
+            cv2.threshold(ws.smoothed, self.edge3_thres, 255, cv2.THRESH_BINARY_INV,
+                          dst=ws.edge)
+            cv2.bitwise_or(ws.binarized, ws.edge, dst=ws.binarized)
+
+        with metrics.stage('edge5'):
+            cv2.filter2D(img_gray, -1, _KERNEL_LAPLACIAN_5X5, dst=ws.edge)
+            cv2.bitwise_not(ws.edge, dst=ws.edge)
+            cv2.filter2D(ws.edge, -1, _KERNEL_GAUSSIAN, dst=ws.smoothed)
+            cv2.threshold(ws.smoothed, self.edge5_thres, 255, cv2.THRESH_BINARY_INV,
+                          dst=ws.edge)
+            return cv2.bitwise_or(ws.binarized, ws.edge, dst=ws.binarized)
+
+    def _segment(self, img_gray, ws=None, offset=(0, 0), shape=None, metrics=_NO_METRICS):
+        # img_gray may be a window at offset in an image of shape
+        if ws is None:
+            ws = DetectorWorkspace(img_gray.shape)
+
+        binarized = self._binarize(img_gray, ws, metrics)
+
+        # Fill the margin and the pixels out of reach with black
+        _fill_margin(binarized, self.margin, offset=offset, shape=shape)
+        self._mask_unreachable(binarized, offset=offset, shape=shape)
 
         # Remove noise
-        kernel = np.ones((3, 3), np.uint8)
-        closed = cv2.morphologyEx(binarized, cv2.MORPH_CLOSE, kernel, iterations=self.closing_iter)
+        with metrics.stage('closing'):
+            closed = morphology.closing(binarized, self.closing_iter, dst=ws.closed)
+
+            _, contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL,
+                                              cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(closed, contours, -1, 255, -1)
 
-        closed, contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cv2.drawContours(closed, contours, -1, 255, -1)
+        # Erosions by squares compose, so the erosion half of the opening is shared
+        with metrics.stage('opening'):
+            half_opened = morphology.erode(closed, self.opening_iter, dst=ws.half_opened)
 
-        opened = cv2.morphologyEx(closed, cv2.MORPH_OPEN, kernel, iterations=self.opening_iter)
+            # Erode
+            if self.erode_iter >= self.opening_iter:
+                eroded = morphology.erode(half_opened, self.erode_iter - self.opening_iter,
+                                          dst=ws.eroded)
+            else:
+                eroded = morphology.erode(closed, self.erode_iter, dst=ws.eroded)
 
-        # Erode
-        eroded = cv2.erode(closed, kernel, iterations=self.erode_iter)
+        # Sure background (dilating the opening is dilating its erosion once more)
+        with metrics.stage('sure_bg'):
+            bg = morphology.dilate(half_opened, self.opening_iter + self.dilate_iter, dst=ws.bg)
+            sure_bg = _remove_small_components(bg, self.bg_size_filter,
+                                               markers=ws.markers, out=ws.sure_bg)
 
-        # Sure background
-        bg = cv2.dilate(opened, kernel, iterations=self.dilate_iter)
-        n, markers_bg, sizes, cogs = cv2.connectedComponentsWithStats(bg)
-        sizes = sizes.take(4, axis=1)
-        sure_bg = bg.copy()
-        for i in range(1, n):
-            if sizes[i] < self.bg_size_filter:
-                sure_bg -= (markers_bg == i).astype(np.uint8) * 255
+        if self.solidity_thres is not None:
+            return self._segment_blobs(eroded, sure_bg, ws, metrics)
+        return self._watershed(eroded, sure_bg, ws, metrics)
 
+    def _segment_blobs(self, eroded, sure_bg, ws, metrics=_NO_METRICS):
+        # Blobs as convex as a single candy are labelled as they are. Only the clusters of
+        # touching candies go through the watershed, inside the box around all of them.
+        # ws.markers still has the components of sure_bg from _remove_small_components.
+        labels = ws.markers
+        with metrics.stage('fast_path'):
+            _, contours, _ = cv2.findContours(sure_bg, cv2.RETR_EXTERNAL,
+                                              cv2.CHAIN_APPROX_SIMPLE)
+            blobs = [(labels[c[0, 0, 1], c[0, 0, 0]], _solidity_of(c), cv2.boundingRect(c))
+                     for c in contours]
+
+            # The last entry is for the labels of the small components removed
+            n = max([b[0] for b in blobs] + [0]) + 2
+            isolated = np.zeros(n, dtype=np.int32)
+            clustered = np.zeros(n, dtype=np.uint8)
+            clusters = []
+            for i, solidity, box in blobs:
+                if solidity >= self.solidity_thres:
+                    isolated[i] = i
+                else:
+                    clustered[i] = 255
+                    clusters.append(box)
+                logger.debug('  Blob at %s: %s (solidity=%.3f)', box,
+                             'fast path' if isolated[i] else 'watershed', solidity)
+        metrics.count('isolated', len(blobs) - len(clusters))
+        metrics.count('clusters', len(clusters))
+
+        cluster_markers = None
+        if clusters:
+            x1 = min(x for x, _, _, _ in clusters)
+            y1 = min(y for _, y, _, _ in clusters)
+            x2 = max(x + w for x, _, w, _ in clusters)
+            y2 = max(y + h for _, y, _, h in clusters)
+            window = (slice(y1, y2), slice(x1, x2))
+            cluster_bg = np.take(clustered, labels[window], mode='clip')
+            cluster_eroded = cv2.bitwise_and(eroded[window], cluster_bg)
+            # A relative sure_fg_thres is relative to the clusters here
+            cluster_markers = self._watershed(cluster_eroded, cluster_bg,
+                                              DetectorWorkspace(cluster_bg.shape), metrics)
+
+        markers = np.take(isolated, labels, out=labels, mode='clip')
+        markers += 1
+        if cluster_markers is not None:
+            # Labels of the clusters follow the labels of the isolated blobs
+            np.copyto(markers[window], cluster_markers + n, where=cluster_markers > 1)
+        return markers
+
+    def _watershed(self, eroded, sure_bg, ws, metrics=_NO_METRICS):
         # Sure foreground
-        dist = cv2.distanceTransform(eroded, cv2.DIST_L2, 5)
-        if self.sure_fg_thres <= 1.0:
-            _, fg = cv2.threshold(dist, self.sure_fg_thres * dist.max(), 255, cv2.THRESH_BINARY)
-        else:
-            _, fg = cv2.threshold(dist, self.sure_fg_thres, 255, cv2.THRESH_BINARY)
-        fg = np.uint8(fg)
+        with metrics.stage('distance_transform'):
+            dist = cv2.distanceTransform(eroded, cv2.DIST_L2, 5, dst=ws.dist)
+            if self.sure_fg_thres <= 1.0:
+                cv2.threshold(dist, self.sure_fg_thres * dist.max(), 255, cv2.THRESH_BINARY,
+                              dst=dist)
+            else:
+                cv2.threshold(dist, self.sure_fg_thres, 255, cv2.THRESH_BINARY, dst=dist)
+            np.copyto(ws.fg, dist, casting='unsafe')
+            fg = ws.fg
 
         # Restore foreground
-        _, markers_eroded = cv2.connectedComponents(eroded)
-
-        oids_eroded, counts_eroded = np.unique(markers_eroded, return_counts=True)
-        oids_fg, counts_fg = np.unique(markers_eroded * (fg > 0), return_counts=True)
-
-        temp = np.array([
-            counts_fg[np.where(oids_fg == oid)[0][0]] if oid in oids_fg else 0
-            for oid in oids_eroded
-        ])
-        oids_sure_fg = oids_eroded[
-            (oids_eroded > 0) & ~(1.0 * temp / counts_eroded > self.restore_fg_thres)
-        ]
-        sure_fg = np.bool_(fg)
-        for oid in oids_sure_fg:
-            sure_fg = np.logical_or(sure_fg, markers_eroded == oid)
-        sure_fg = 255 * np.uint8(sure_fg)
+        with metrics.stage('restore_fg'):
+            sure_fg = _restore_foreground(fg, eroded, self.restore_fg_thres,
+                                          markers=ws.markers, mask=ws.mask, out=ws.sure_fg)
 
         # Unknown region
         # unknown = cv2.subtract(sure_bg, sure_fg)
 
-        # Label
-        _, markers = cv2.connectedComponents(sure_fg)
+        # Label and segmentate
+        # (distanceTransformWithLabels labels the connected components of sure_fg by itself)
+        with metrics.stage('labelling'):
+            cv2.bitwise_not(sure_fg, dst=ws.edge)
+            _, markers = cv2.distanceTransformWithLabels(ws.edge, cv2.DIST_L2, 5, dst=ws.dist,
+                                                         labels=ws.markers)
+            np.floor_divide(sure_bg, 255, out=sure_bg)
+            np.multiply(markers, sure_bg, out=markers)
+            markers += 1
+        return markers
 
-        # Segmentate
-        _, markers = cv2.distanceTransformWithLabels(255 - sure_fg, cv2.DIST_L2, 5, labels=markers)
-        markers = (sure_bg // 255) * markers
-        markers += 1
+    def _mask_unreachable(self, binarized, offset=(0, 0), shape=None):
+        # binarized may be a window at offset in an image of shape
+        h, w = binarized.shape
+        if self.reach_mask is None or self.reach_mask.shape != (shape or (h, w)):
+            return
+        oy, ox = offset
+        cv2.bitwise_and(binarized, self.reach_mask[oy:oy + h, ox:ox + w], dst=binarized)
 
-        candies = []
-        for i in [i for i in list(np.unique(markers)) if i > 1]:
-            temp = np.zeros(markers.shape, dtype='uint8')
-            temp[markers == i] = 255
-            _, _contours, _ = cv2.findContours(temp, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            contour = _contours[0]
+    def _candy_of(self, img, window, mask, contour):
+        box_coords, box_dims, box_centroid = _bounding_box_of(contour)
+        if any([dim <= self.box_dim_thres for dim in box_dims]):
+            return None
 
-            box_coords, box_dims, box_centroid = _bounding_box_of(contour)
-            if any([dim <= self.box_dim_thres for dim in box_dims]):
-                continue
-            cropped_img = _crop_candy(img, markers != i, box_coords, box_dims, box_centroid)
+        return Candy(box_coords=box_coords,
+                     box_dims=box_dims,
+                     box_centroid=box_centroid,
+                     crop=partial(_crop_candy, img, window, mask, box_coords, box_dims,
+                                  box_centroid, size=self.crop_size))
 
-            candies.append(Candy(box_coords=box_coords,
-                                 box_dims=box_dims,
-                                 box_centroid=box_centroid,
-                                 cropped_img=cropped_img))
 
-        return candies
+class BackgroundCandyDetector(CandyDetector):
+    """Detects candies by the difference from learned frames of the empty table.
+
+    Frames of another shape than the learned ones are detected by CandyDetector.
+    """
+
+    def __init__(self, diff_thres=30, **kwargs):
+        super(BackgroundCandyDetector, self).__init__(**kwargs)
+        self.diff_thres = diff_thres
+        self.backgrounds = {}
+
+    @classmethod
+    def from_config(cls, config):
+        detector = super(BackgroundCandyDetector, cls).from_config(config)
+        detector.diff_thres = config.CANDY_DETECTOR_DIFF_THRES
+        return detector
+
+    def learn(self, imgs):
+        # The median of a few frames has no noise of a single frame
+        grays = [cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) for img in imgs]
+        background = np.median(grays, axis=0).astype(np.uint8) if len(grays) > 1 else grays[0]
+        self.backgrounds[background.shape] = background
+
+    def _detect(self, img, metrics):
+        if img.shape[:2] not in self.backgrounds:
+            logger.warning('  No background of %s learned.', img.shape[:2])
+            return super(BackgroundCandyDetector, self)._detect(img, metrics)
+
+        with self._workspace(img.shape[:2]) as ws:
+            with metrics.stage('gray'):
+                img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=ws.gray)
+
+            if self.workers > 1:
+                return self._detect_tiled(img, img_gray, metrics)
 
+            markers = self._segment(img_gray, ws, metrics=metrics)
+            return self._candies_of(img, markers, metrics=metrics)
 
-def _crop_candy(img, mask, box_coords, box_dims, box_centroid):
+    def _segment(self, img_gray, ws=None, offset=(0, 0), shape=None, metrics=_NO_METRICS):
+        # img_gray may be a window at offset in an image of shape
+        oy, ox = offset
+        h, w = img_gray.shape
+        background = self.backgrounds.get(shape if shape is not None else (h, w))
+        if background is None:
+            return super(BackgroundCandyDetector, self)._segment(img_gray, ws, offset, shape,
+                                                                 metrics)
+        if ws is None:
+            ws = DetectorWorkspace(img_gray.shape)
 
-    # White out other than candy
-    _img = img.copy()
-    _img[mask] = 255
+        with metrics.stage('difference'):
+            cv2.absdiff(img_gray, background[oy:oy + h, ox:ox + w], dst=ws.edge)
+            binarized = cv2.threshold(ws.edge, self.diff_thres, 255, cv2.THRESH_BINARY,
+                                      dst=ws.binarized)[1]
+        _fill_margin(binarized, self.margin, offset=offset, shape=shape)
+        self._mask_unreachable(binarized, offset=offset, shape=shape)
+
+        # Fill holes, e.g. the parts of candies as bright as the table, and remove noise
+        with metrics.stage('closing'):
+            closed = morphology.closing(binarized, self.closing_iter, dst=ws.closed)
+            _, contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL,
+                                              cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(closed, contours, -1, 255, -1)
+
+        with metrics.stage('opening'):
+            opened = morphology.opening(closed, self.opening_iter, dst=ws.half_opened)
+
+        with metrics.stage('sure_bg'):
+            sure_bg = _remove_small_components(opened, self.bg_size_filter,
+                                               markers=ws.markers, out=ws.sure_bg)
+
+        # Only touching candies need the seeds of the watershed
+        with metrics.stage('erode'):
+            eroded = morphology.erode(sure_bg, self.erode_iter, dst=ws.eroded)
+
+        if self.solidity_thres is not None:
+            return self._segment_blobs(eroded, sure_bg, ws, metrics)
+        return self._watershed(eroded, sure_bg, ws, metrics)
+
+
+def _solidity_of(contour):
+    hull_area = cv2.contourArea(cv2.convexHull(contour))
+    return cv2.contourArea(contour) / hull_area if hull_area > 0 else 1.0
+
+
+def _log_metrics(metrics):
+    logger.info('  Detection stages: total=%.1fms, %s', metrics.total * 1000, metrics)
+
+
+def _tiles_of(shape, n, overlap):
+    # Split into rows x cols == n tiles whose aspect ratio is closest to the image
+    h, w = shape
+    rows = min([r for r in range(1, n + 1) if n % r == 0],
+               key=lambda r: abs(np.log((w / (n // r)) / (h / r))))
+    cols = n // rows
+    ys = np.linspace(0, h, rows + 1).astype(int)
+    xs = np.linspace(0, w, cols + 1).astype(int)
+
+    tiles = []
+    for y1, y2 in zip(ys[:-1], ys[1:]):
+        for x1, x2 in zip(xs[:-1], xs[1:]):
+            window = (slice(max(y1 - overlap, 0), min(y2 + overlap, h)),
+                      slice(max(x1 - overlap, 0), min(x2 + overlap, w)))
+            tiles.append(((y1, x1, y2, x2), window))
+    return tiles
+
+
+def _fill_margin(binarized, margin, offset=(0, 0), shape=None):
+    # binarized may be a window at offset in an image of shape
+    h, w = shape if shape is not None else binarized.shape
+    oy, ox = offset
+    binarized[:max(margin[0] - oy, 0), :] = 0
+    binarized[max(h - margin[0] - oy, 0):, :] = 0
+    binarized[:, :max(margin[1] - ox, 0)] = 0
+    binarized[:, max(w - margin[1] - ox, 0):] = 0
+
+
+def _remove_small_components(mask, min_size, markers=None, out=None):
+    # Sizes come from the component stats, so the removal is a single lookup over the labels.
+    _, markers, stats, _ = cv2.connectedComponentsWithStats(mask, labels=markers)
+    lut = np.where(stats[:, cv2.CC_STAT_AREA] < min_size, 0, 255).astype(np.uint8)
+    lut[0] = 0
+    return np.take(lut, markers, out=out, mode='clip')
+
+
+def _restore_foreground(fg, eroded, thres, markers=None, mask=None, out=None):
+    # Components of eroded whose fraction of fg pixels is not above thres are restored entirely.
+    n, markers = cv2.connectedComponents(eroded, labels=markers)
+    mask = np.greater(fg, 0, out=mask)
+    counts = np.bincount(markers.ravel(), minlength=n)
+    counts_fg = np.bincount(markers[mask], minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        restore = ~(1.0 * counts_fg / counts > thres)
+    restore[0] = False
+    lut = np.where(restore, 255, 0).astype(np.uint8)
+    out = np.take(lut, markers, out=out, mode='clip')
+    out[mask] = 255
+    return out
+
+
+def _changed_boxes(prev_gray, img_gray, diff_thres, min_area):
+    # Boxes (x1, y1, x2, y2) of the regions changed between the frames and the changed area
+    diff = cv2.absdiff(prev_gray, img_gray)
+    _, changed = cv2.threshold(diff, diff_thres, 255, cv2.THRESH_BINARY)
+    changed = cv2.dilate(changed, _KERNEL, iterations=2)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(changed)
+    boxes = [(x, y, x + bw, y + bh) for x, y, bw, bh, area in stats[1:] if area >= min_area]
+    return boxes, stats[1:, cv2.CC_STAT_AREA].sum()
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _union_of(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def _merge_boxes(boxes):
+    # Merge intersecting boxes until all boxes are disjoint
+    merged = []
+    for box in boxes:
+        while True:
+            overlapped = [m for m in merged if _intersects(m, box)]
+            if not overlapped:
+                break
+            merged = [m for m in merged if not _intersects(m, box)]
+            box = _union_of(overlapped + [box])
+        merged.append(box)
+    return sorted(merged)
+
+
+def _regions_of(markers, start_label=1):
+    # Bounding boxes of all labels are found in a single pass over markers.
+    # Each window is padded by 1px so that findContours never sees the region touching its border.
+    h, w = markers.shape
+    for i, bbox in enumerate(ndimage.find_objects(markers), 1):
+        if bbox is None or i < start_label:
+            continue
+        ys, xs = bbox
+        window = (slice(max(ys.start - 1, 0), min(ys.stop + 1, h)),
+                  slice(max(xs.start - 1, 0), min(xs.stop + 1, w)))
+        yield i, window, markers[window] == i
+
+
+def _crop_candy(img, window, mask, box_coords, box_dims, box_centroid, size=None):
+
+    # White out other than candy, only inside the window of the candy
+    _img = img[window].copy()
+    _img[~mask] = 255
+
+    # Origin of the window in the image
+    oy, ox = window[0].start, window[1].start
 
     # Center of image
-    h, w, _ = _img.shape
+    h, w, _ = img.shape
     center = (w / 2, h / 2)
 
     # Get bounding box coordinates
@@ -236,6 +984,9 @@ def _crop_candy(img, mask, box_coords, box_dims, box_centroid):
     # Center of bounding pox
     tx, ty = box_centroid
 
+    # Translation matrix to move the window back to its place in the image
+    window_mat = np.float32([[1, 0, ox], [0, 1, oy], [0, 0, 1]])
+
     # Translation matrix to move candy to center of image
     trans_mat = np.float32([[1, 0, -tx + w / 2], [0, 1, -ty + h / 2], [0, 0, 1]])
 
@@ -243,21 +994,28 @@ def _crop_candy(img, mask, box_coords, box_dims, box_centroid):
     rot_mat = cv2.getRotationMatrix2D(center, angle, 1)
     rot_mat = np.vstack((rot_mat, [0, 0, 1]))
 
-    # Translation+Rotation matrix
-    mat = np.dot(rot_mat, trans_mat)
-
-    # Transform image
-    _img = cv2.warpAffine(_img, mat[0:2, :], (w, h), borderValue=(255, 255, 255))
-
     # Crop candy
     pwh = max(pw, ph)
 
-    cx1 = int(np.floor((w - pwh) / 2))
-    cx2 = int(np.ceil((w + pwh) / 2))
-    cy1 = int(np.floor((h - pwh) / 2))
-    cy2 = int(np.ceil((h + pwh) / 2))
+    if size is None:
+        # Same crop as cutting out the candy from the whole transformed image
+        cx1 = int(np.floor((w - pwh) / 2))
+        cx2 = int(np.ceil((w + pwh) / 2))
+        cy1 = int(np.floor((h - pwh) / 2))
+        cy2 = int(np.ceil((h + pwh) / 2))
+        crop_mat = np.float32([[1, 0, -cx1], [0, 1, -cy1], [0, 0, 1]])
+        dsize = (cx2 - cx1, cy2 - cy1)
+    else:
+        # Scale the crop to size x size
+        s = size / pwh
+        crop_mat = np.float32([[s, 0, (pwh - w) * s / 2], [0, s, (pwh - h) * s / 2], [0, 0, 1]])
+        dsize = (size, size)
+
+    # Window+Translation+Rotation+Crop matrix
+    mat = np.dot(crop_mat, np.dot(rot_mat, np.dot(trans_mat, window_mat)))
 
-    return _img[cy1:cy2, cx1:cx2]
+    # Transform only the window into the crop
+    return cv2.warpAffine(_img, mat[0:2, :], dsize, borderValue=(255, 255, 255))
 
 
 def _bounding_box_of(contour):
@@ -283,6 +1041,9 @@ def _bounding_box_of(contour):
 
 
 def detect_labels(img):
+    global vision_client
+    if vision_client is None:
+        vision_client = vision.Client()
     image = vision_client.image(content=cv2.imencode('.jpg', img)[1].tostring())
     try:
         texts = image.detect_text()
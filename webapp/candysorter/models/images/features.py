@@ -0,0 +1,377 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+import hashlib
+import io
+import logging
+import mmap
+from multiprocessing import Pipe, Process
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+import threading
+import traceback
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Of inception-v3, as in trainer.feature_extractor
+FEATURE_SIZE = 2048
+
+
+class FeatureCache(object):
+    """Feature vectors of candy crops, keyed by the content of the crops.
+
+    Crops are the same if their pixels are, or with hash_tolerance, if the 64-bit difference
+    hashes of them differ in at most that many bits. The least recently used vectors are evicted
+    to keep them within max_bytes. The vectors are of the backbone set by set_backbone().
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, hash_tolerance=None):
+        self.max_bytes = max_bytes
+        self.hash_tolerance = hash_tolerance
+        self.backbone = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_bytes=config.FEATURE_CACHE_MAX_BYTES,
+                   hash_tolerance=config.FEATURE_CACHE_HASH_TOLERANCE)
+
+    def set_backbone(self, model_file):
+        # Cleared only if the model extracting the vectors has changed
+        digest = _digest_of(model_file)
+        with self._lock:
+            if digest != self.backbone:
+                if self.backbone is not None:
+                    logger.info('Feature cache cleared for the new backbone %s.', model_file)
+                self._clear()
+                self.backbone = digest
+
+    def get_feature_vectors(self, imgs, extract):
+        """Feature vectors of imgs as a matrix, extracting those not in the cache by extract."""
+        if self.max_bytes <= 0 or not imgs:
+            return extract(imgs)
+
+        keys = [self._key_of(img) for img in imgs]
+        vectors = [None] * len(imgs)
+        with self._lock:
+            for i, key in enumerate(keys):
+                vectors[i] = self._get(key)
+        missed = [i for i, v in enumerate(vectors) if v is None]
+
+        if missed:
+            extracted = extract([imgs[i] for i in missed])
+            with self._lock:
+                for i, vector in zip(missed, extracted):
+                    # A copy, not to keep the whole batch for a row of it
+                    vectors[i] = np.array(vector, dtype=np.float32)
+                    self._put(keys[i], vectors[i])
+
+        with self._lock:
+            self.hits += len(imgs) - len(missed)
+            self.misses += len(missed)
+        return np.stack(vectors)
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def __str__(self):
+        return 'hits={} misses={} evictions={} vectors={} bytes={}'.format(
+            self.hits, self.misses, self.evictions, len(self), self.bytes)
+
+    def _key_of(self, img):
+        img = np.ascontiguousarray(img)
+        if self.hash_tolerance is None:
+            return hashlib.sha1(repr(img.shape).encode('ascii') + img.tobytes()).hexdigest()
+        return _dhash_of(img)
+
+    def _get(self, key):
+        if self.hash_tolerance:
+            key = self._nearest(key)
+        vector = self._vectors.pop(key, None)
+        if vector is not None:
+            # Most recently used last
+            self._vectors[key] = vector
+        return vector
+
+    def _nearest(self, key):
+        if not self._vectors:
+            return key
+        keys = list(self._vectors)
+        distances = _hamming(np.array(keys, dtype=np.uint64), key)
+        i = np.argmin(distances)
+        return keys[i] if distances[i] <= self.hash_tolerance else key
+
+    def _put(self, key, vector):
+        if key in self._vectors:
+            return
+        self._vectors[key] = vector
+        self.bytes += vector.nbytes
+        while self.bytes > self.max_bytes and self._vectors:
+            _, evicted = self._vectors.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def _clear(self):
+        self._vectors.clear()
+        self.bytes = 0
+
+
+class FeaturePool(object):
+    """Feature extractors of inception-v3 in worker processes, used as a FeatureExtractor.
+
+    Each worker loads the model once and has a shared memory buffer of buffer_bytes, through
+    which the crops go to it and the feature vectors come back, so only their shapes and offsets
+    are pickled. A batch is split among the workers, and calls from several threads wait for
+    free ones. The workers are forked, so start it before any TensorFlow session of the process.
+    """
+
+    def __init__(self, model_file, processes=1, buffer_bytes=16 * 1024 * 1024,
+                 intra_op_threads=0, inter_op_threads=0):
+        if buffer_bytes < FEATURE_SIZE * 4:
+            raise ValueError('buffer_bytes must hold a feature vector at least.')
+        self.model_file = model_file
+        self.processes = processes
+        self.buffer_bytes = buffer_bytes
+        self._workers = []
+        self._free = Queue()
+        self._threads = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+        try:
+            for i in range(processes):
+                conn, child_conn = Pipe()
+                buf = mmap.mmap(-1, buffer_bytes)
+                process = Process(
+                    target=_serve, name='feature-worker-{}'.format(i),
+                    args=(child_conn, buf, model_file, intra_op_threads, inter_op_threads,
+                          [w.conn for w in self._workers])
+                )
+                process.daemon = True
+                process.start()
+                child_conn.close()
+                self._workers.append(_Worker(process, conn, buf))
+            for worker in self._workers:
+                _reply_of(worker)
+                self._free.put(worker)
+        except Exception:
+            self.close()
+            raise
+        self._threads = ThreadPool(processes)
+        logger.info('Started %d feature workers of %s.', processes, model_file)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.INCEPTION_MODEL_FILE,
+                   processes=config.FEATURE_POOL_PROCESSES,
+                   buffer_bytes=config.FEATURE_POOL_BUFFER_BYTES,
+                   intra_op_threads=config.INCEPTION_INTRA_OP_THREADS,
+                   inter_op_threads=config.INCEPTION_INTER_OP_THREADS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def alive(self):
+        return not self._closed and all(w.process.is_alive() for w in self._workers)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        workers = self._workers
+        if self._threads is not None:
+            # After the extractions in progress
+            for _ in workers:
+                self._free.get()
+            self._threads.close()
+            self._threads = None
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (IOError, OSError):
+                pass
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+            worker.buf.close()
+        # For the calls waiting for a worker, which find it closed
+        for worker in workers:
+            self._free.put(worker)
+
+    def get_feature_vectors(self, imgs):
+        """Feature vectors of images as an N x 2048 matrix, the same as of FeatureExtractor."""
+        imgs = [np.ascontiguousarray(img, dtype=np.uint8) for img in imgs]
+        chunks = self._chunks([img.nbytes for img in imgs])
+        features = self._map(lambda chunk: self._extract('images', [imgs[i] for i in chunk]),
+                             chunks)
+        return np.concatenate([np.zeros((0, FEATURE_SIZE), dtype=np.float32)] + features)
+
+    def get_feature_vectors_from_files(self, image_paths):
+        chunks = self._chunks([0] * len(image_paths))
+        features = self._map(
+            lambda chunk: self._extract('files', [image_paths[i] for i in chunk]), chunks)
+        return [vector for f in features for vector in f]
+
+    def _chunks(self, sizes):
+        # Split among the workers, and each part into what fits the buffer
+        max_vectors = self.buffer_bytes // (FEATURE_SIZE * 4)
+        chunks = []
+        for part in np.array_split(np.arange(len(sizes)), max(self.processes, 1)):
+            chunk, nbytes = [], 0
+            for i in part:
+                if sizes[i] > self.buffer_bytes:
+                    raise ValueError('An image of {} bytes is larger than the buffer of {} bytes.'
+                                     .format(sizes[i], self.buffer_bytes))
+                if chunk and (nbytes + sizes[i] > self.buffer_bytes or
+                              len(chunk) >= max_vectors):
+                    chunks.append(chunk)
+                    chunk, nbytes = [], 0
+                chunk.append(i)
+                nbytes += sizes[i]
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def _map(self, func, chunks):
+        if self._closed:
+            raise RuntimeError('FeaturePool is already closed.')
+        if len(chunks) <= 1:
+            return [func(chunk) for chunk in chunks]
+        return self._threads.map(func, chunks)
+
+    def _extract(self, kind, items):
+        worker = self._free.get()
+        try:
+            if self._closed:
+                raise RuntimeError('FeaturePool is already closed.')
+            if kind == 'images':
+                args, offset = [], 0
+                for img in items:
+                    _view(worker.buf, np.uint8, img.shape, offset)[...] = img
+                    args.append((img.shape, offset))
+                    offset += img.nbytes
+            else:
+                args = items
+            worker.conn.send((kind, args))
+            n = _reply_of(worker)
+            return _view(worker.buf, np.float32, (n, FEATURE_SIZE)).copy()
+        finally:
+            self._free.put(worker)
+
+
+class _Worker(object):
+    def __init__(self, process, conn, buf):
+        self.process = process
+        self.conn = conn
+        self.buf = buf
+
+
+def _reply_of(worker):
+    try:
+        status, value = worker.conn.recv()
+    except (EOFError, IOError):
+        raise RuntimeError('{} has exited with {}.'.format(worker.process.name,
+                                                           worker.process.exitcode))
+    if status == 'error':
+        raise RuntimeError('{} failed:\n{}'.format(worker.process.name, value))
+    return value
+
+
+def _serve(conn, buf, model_file, intra_op_threads, inter_op_threads, inherited):
+    # The connections of the other workers, not to keep them open
+    for c in inherited:
+        c.close()
+    try:
+        extractor = _load_extractor(model_file, intra_op_threads, inter_op_threads)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+    conn.send(('ok', None))
+
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            try:
+                conn.send(('ok', _handle(extractor, buf, *request)))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    finally:
+        extractor.close()
+
+
+def _load_extractor(model_file, intra_op_threads, inter_op_threads):
+    # Imported here, so that the process starting the workers does not load TensorFlow for them
+    from trainer.feature_extractor import FeatureExtractor
+    return FeatureExtractor(model_file, intra_op_threads=intra_op_threads,
+                            inter_op_threads=inter_op_threads)
+
+
+def _handle(extractor, buf, kind, args):
+    if kind == 'images':
+        imgs = [_view(buf, np.uint8, shape, offset) for shape, offset in args]
+        features = extractor.get_feature_vectors(imgs)
+    else:
+        features = np.float32(extractor.get_feature_vectors_from_files(args))
+    features = np.reshape(features, (-1, FEATURE_SIZE))
+    # Over the images, which are no longer used
+    _view(buf, np.float32, features.shape)[...] = features
+    return len(features)
+
+
+def _view(buf, dtype, shape, offset=0):
+    return np.frombuffer(buf, dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+
+def _dhash_of(img):
+    # Whether each pixel is brighter than the next of the 9x8 thumbnail, as 64 bits
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int(bits.view('>u8')[0])
+
+
+def _hamming(keys, key):
+    bits = np.unpackbits((keys ^ np.uint64(key)).view(np.uint8)).reshape(len(keys), -1)
+    return bits.sum(axis=1)
+
+
+def _digest_of(path, chunk_size=1024 * 1024):
+    sha1 = hashlib.sha1()
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
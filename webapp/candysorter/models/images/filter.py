@@ -15,55 +15,117 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import io
+import logging
+import os
+
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
+# Whether the arm can pick at each 0.1 step of the robot coordinates, in rows of y from -1.5 to
+# 1.5 and columns of x from -1.0 to 1.0. Generated from the calibration data of the arm by
+# setup/script/make_pickable_map.py.
+PICKABLE_MAP_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                                 'resources', 'pickable_map.txt')
+
 
 def _rx_to_ax(x_robot):
     x = round(x_robot, 1)
-    return int((x + 1.0) * 10)
+    return int(round((x + 1.0) * 10))
 
 
 def _ry_to_ay(y_robot):
     y = round(y_robot, 1)
-    return int((y + 1.5) * 10)
+    return int(round((y + 1.5) * 10))
+
+
+def make_pickable_map(adjust_data):
+    # adjust_data is of robot-arm/calibration/adjust_data.json, in which the cells the arm
+    # cannot reach are None. Cells missing in it are not pickable either.
+    pickables = np.zeros((31, 21), dtype=bool)
+    for key, value in adjust_data.items():
+        x, y = (float(v) for v in key.split(','))
+        x_array, y_array = _rx_to_ax(x), _ry_to_ay(y)
+        if not (0 <= x_array < pickables.shape[1] and 0 <= y_array < pickables.shape[0]):
+            logger.warning('Ignored %s out of the table in the calibration data.', key)
+            continue
+        pickables[y_array, x_array] = value is not None
+    return pickables
+
+
+def save_pickable_map(path, pickables):
+    with io.open(path, 'w') as f:
+        for row in pickables:
+            f.write(''.join('#' if p else '.' for p in row) + '\n')
+
+
+def load_pickable_map(path):
+    with io.open(path) as f:
+        return np.array([[c == '#' for c in line.strip()] for line in f if line.strip()])
 
 
 def _pickable_coords():
-    c = np.ones((31, 21), dtype=bool)
-    c[_ry_to_ay(-1.2):_ry_to_ay(1.2) + 1, _rx_to_ax(-1.0)] = False
-    c[_ry_to_ay(-1.1):_ry_to_ay(1.1) + 1, _rx_to_ax(-0.9)] = False
-    c[_ry_to_ay(-1.0):_ry_to_ay(1.0) + 1, _rx_to_ax(-0.8)] = False
-    c[_ry_to_ay(-0.9):_ry_to_ay(0.9) + 1, _rx_to_ax(-0.7)] = False
-    c[_ry_to_ay(-0.8):_ry_to_ay(0.8) + 1, _rx_to_ax(-0.6)] = False
-    c[_ry_to_ay(-0.6):_ry_to_ay(0.6) + 1, _rx_to_ax(-0.5)] = False
-    c[_ry_to_ay(-0.3):_ry_to_ay(0.3) + 1, _rx_to_ax(-0.4)] = False
-    c[:_ry_to_ay(-1.4) + 1, _rx_to_ax(0.5)], c[_rx_to_ax(1.4):, _rx_to_ax(0.5)] = False, False
-    c[:_ry_to_ay(-1.2) + 1, _rx_to_ax(0.6)], c[_rx_to_ax(1.2):, _rx_to_ax(0.6)] = False, False
-    c[:_ry_to_ay(-1.0) + 1, _rx_to_ax(0.7)], c[_rx_to_ax(1.0):, _rx_to_ax(0.7)] = False, False
-    c[:_ry_to_ay(-0.6) + 1, _rx_to_ax(0.8)], c[_rx_to_ax(0.6):, _rx_to_ax(0.8)] = False, False
-    c[:, _rx_to_ax(0.9)] = False
-    c[:, _rx_to_ax(1.0)] = False
-    return c
-
-
-_PICKABLE_COORDS = _pickable_coords()
+    # Loaded on first use, so that the map can be made without it
+    global _PICKABLE_COORDS
+    if _PICKABLE_COORDS is None:
+        _PICKABLE_COORDS = load_pickable_map(PICKABLE_MAP_FILE)
+    return _PICKABLE_COORDS
+
+
+_PICKABLE_COORDS = None
+
+# pickable_mask by the area and scale of calibrators
+_pickable_masks = {}
 
 
 def _pickable(x_robot, y_robot):
     x_array = _rx_to_ax(x_robot)
     y_array = _ry_to_ay(y_robot)
+    coords = _pickable_coords()
     return (
-        0 <= x_array < _PICKABLE_COORDS.shape[1] and
-        0 <= y_array < _PICKABLE_COORDS.shape[0] and
-        _PICKABLE_COORDS[y_array, x_array]
+        0 <= x_array < coords.shape[1] and
+        0 <= y_array < coords.shape[0] and
+        coords[y_array, x_array]
     )
 
 
+def pickable_mask(calibrator):
+    # Pixels of the calibrated image at which the centroid of a candy is pickable
+    w, h = calibrator.area
+    ys, xs = np.ogrid[0:h, 0:w]
+    x_robot, y_robot = calibrator.get_coordinate(xs, ys)
+    x_array = np.vectorize(_rx_to_ax, otypes=[int])(x_robot)
+    y_array = np.vectorize(_ry_to_ay, otypes=[int])(y_robot)
+    x_array, y_array = np.broadcast_arrays(x_array, y_array)
+
+    coords = _pickable_coords()
+    inside = ((0 <= x_array) & (x_array < coords.shape[1]) &
+              (0 <= y_array) & (y_array < coords.shape[0]))
+    mask = np.zeros((h, w), dtype=bool)
+    mask[inside] = coords[y_array[inside], x_array[inside]]
+    return mask
+
+
+def pickable_at(calibrator, points):
+    # Boolean mask of the pixels in an (n, 2) array of x, y which are pickable, by looking up
+    # the pickable mask of the calibrator. Pixels outside of its area are converted one by one.
+    key = (tuple(calibrator.area), calibrator.scale)
+    if key not in _pickable_masks:
+        _pickable_masks[key] = pickable_mask(calibrator)
+    mask = _pickable_masks[key]
+
+    points = np.asarray(points, dtype=int).reshape(-1, 2)
+    xs, ys = points.T
+    inside = (0 <= xs) & (xs < mask.shape[1]) & (0 <= ys) & (ys < mask.shape[0])
+    pickables = np.zeros(len(points), dtype=bool)
+    pickables[inside] = mask[ys[inside], xs[inside]]
+    for i in np.flatnonzero(~inside):
+        pickables[i] = _pickable(*calibrator.get_coordinate(xs[i], ys[i]))
+    return pickables
+
+
 def exclude_unpickables(calibrator, candies):
-    l = []
-    for c in candies:
-        x, y = calibrator.get_coordinate(c.box_centroid[0], c.box_centroid[1])
-        if not _pickable(x, y):
-            continue
-        l.append(c)
-    return l
+    if isinstance(candies, list):
+        return [c for c in candies if _pickable(*calibrator.get_coordinate(*c.box_centroid))]
+    return candies[candies.pickable(calibrator)]
@@ -0,0 +1,74 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cv2
+import numpy as np
+
+# Binary morphology of masks of 0 and 255, equal to repeating cv2.erode / cv2.dilate with a
+# 3x3 kernel of ones for the given iterations.
+#
+# k iterations of the 3x3 kernel are the (2k + 1) x (2k + 1) square in a single pass, which is
+# O(k) per pixel. From BOX_MIN_ITER on, the square is counted with a box filter instead, which
+# is O(1) per pixel. Outside of the image is ignored in both, like the default border of OpenCV.
+
+BOX_MIN_ITER = 15
+
+
+def erode(src, iterations, dst=None):
+    if iterations <= 0:
+        return _copy(src, dst)
+    size = 2 * iterations + 1
+    if iterations < BOX_MIN_ITER:
+        return cv2.erode(src, _square(size), dst=dst)
+    return cv2.compare(_count(src, size), size * size, cv2.CMP_GE, dst=dst)
+
+
+def dilate(src, iterations, dst=None):
+    if iterations <= 0:
+        return _copy(src, dst)
+    size = 2 * iterations + 1
+    if iterations < BOX_MIN_ITER:
+        return cv2.dilate(src, _square(size), dst=dst)
+    return cv2.compare(_count(src, size), 0, cv2.CMP_GT, dst=dst)
+
+
+def closing(src, iterations, dst=None):
+    return erode(dilate(src, iterations, dst=dst), iterations, dst=dst)
+
+
+def opening(src, iterations, dst=None):
+    return dilate(erode(src, iterations, dst=dst), iterations, dst=dst)
+
+
+def _square(size):
+    return cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+
+
+def _count(src, size):
+    # Number of non-zero pixels in the square around each pixel. Replicating the border counts
+    # the same as ignoring it, because the pixels at the border are inside the square anyway.
+    ones = cv2.threshold(src, 0, 1, cv2.THRESH_BINARY)[1]
+    return cv2.boxFilter(ones, cv2.CV_16U if size * size < 2 ** 16 else cv2.CV_32F,
+                         (size, size), normalize=False, borderType=cv2.BORDER_REPLICATE)
+
+
+def _copy(src, dst):
+    if dst is None:
+        return src.copy()
+    if dst is not src:
+        np.copyto(dst, src)
+    return dst
@@ -46,8 +46,15 @@ class CandyTrainer(object):
         self.storage_client = storage.Client()
 
     @classmethod
-    def from_config(cls, config):
-        return cls(feature_extractor=FeatureExtractor(config.INCEPTION_MODEL_FILE),
+    def from_config(cls, config, feature_extractor=None):
+        # The classifier can extract them, not to load inception-v3 twice
+        if feature_extractor is None:
+            feature_extractor = FeatureExtractor(
+                config.INCEPTION_MODEL_FILE,
+                intra_op_threads=config.INCEPTION_INTRA_OP_THREADS,
+                inter_op_threads=config.INCEPTION_INTER_OP_THREADS
+            )
+        return cls(feature_extractor=feature_extractor,
                    package_uris=config.CLOUD_ML_PACKAGE_URIS,
                    python_module=config.CLOUD_ML_PYTHON_MODULE,
                    data_dir_format=config.CLOUD_ML_DATA_DIR,
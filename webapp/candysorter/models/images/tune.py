@@ -0,0 +1,188 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import namedtuple, OrderedDict
+import glob
+import io
+import json
+import logging
+from multiprocessing import Pool
+import os
+from timeit import default_timer
+
+import cv2
+import numpy as np
+
+from candysorter.models.images.detect import CandyDetector
+
+logger = logging.getLogger(__name__)
+
+# Arguments of CandyDetector set by CANDY_DETECTOR_<NAME> of the config
+DETECTOR_PARAMS = [
+    'histgram_band', 'histgram_thres', 'bin_thres', 'edge3_thres', 'edge5_thres', 'margin',
+    'closing_iter', 'opening_iter', 'erode_iter', 'dilate_iter', 'bg_size_filter',
+    'sure_fg_thres', 'restore_fg_thres', 'box_dim_thres', 'scale', 'solidity_thres',
+    'largest_fragment',
+]
+
+SEARCH_SPACE = OrderedDict([
+    ('bin_thres', [130, 140, 150, 160, 170]),
+    ('edge3_thres', [230, 240, 250]),
+    ('edge5_thres', [210, 220, 230, 240]),
+    ('closing_iter', [1, 2, 3, 5]),
+    ('opening_iter', [1, 2, 3, 5]),
+    ('erode_iter', [5, 10, 15, 20, 25]),
+    ('dilate_iter', [0, 1, 2, 3]),
+    ('bg_size_filter', [1000, 2000, 3000]),
+    ('sure_fg_thres', [5, 10, 15]),
+    ('solidity_thres', [None, 0.9, 0.95]),
+    ('largest_fragment', [False, True]),
+    ('scale', [0.5, 1.0]),
+])
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+Trial = namedtuple('Trial', ['params', 'precision', 'recall', 'f1', 'latency'])
+
+# Of each worker process of tune()
+_dataset, _repeat = None, None
+
+
+def load_dataset(directory):
+    """Loads the calibrated images in directory with the candies in them.
+
+    The candies of foo.jpg are in foo.json as [{"box": [[x, y], ...]}, ...], the same as
+    CandySet.to_json(), so that detected candies can be saved and corrected by hand.
+    """
+    dataset = []
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        stem, ext = os.path.splitext(path)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        if not os.path.isfile(stem + '.json'):
+            logger.warning('Skipped %s without %s.json.', path, stem)
+            continue
+        with io.open(stem + '.json') as f:
+            boxes = [np.float32(c['box']) for c in json.load(f)]
+        dataset.append((cv2.imread(path), boxes))
+    return dataset
+
+
+def params_of(config):
+    return OrderedDict((name, getattr(config, 'CANDY_DETECTOR_' + name.upper()))
+                       for name in DETECTOR_PARAMS)
+
+
+def sample_params(base, n, space=SEARCH_SPACE, seed=0):
+    # base first, then up to n - 1 distinct random combinations of space
+    rng = np.random.RandomState(seed)
+    sampled = [base]
+    seen = {tuple(base[name] for name in space)}
+    for _ in range(100 * n):
+        if len(sampled) >= n:
+            break
+        values = tuple(choices[rng.randint(len(choices))] for choices in space.values())
+        if values in seen:
+            continue
+        seen.add(values)
+        params = OrderedDict(base)
+        params.update(zip(space, values))
+        sampled.append(params)
+    return sampled
+
+
+def score(candies, boxes):
+    """Matched candies, where each true box matches the first candy with the centroid in it."""
+    matched = 0
+    unmatched = list(boxes)
+    for c in candies:
+        point = tuple(float(v) for v in c.box_centroid)
+        for i, box in enumerate(unmatched):
+            if cv2.pointPolygonTest(box, point, False) >= 0:
+                matched += 1
+                del unmatched[i]
+                break
+    return matched
+
+
+def evaluate(params, dataset, repeat=3):
+    detector = CandyDetector(**params)
+    matched, n_detected, n_truth = 0, 0, 0
+    latencies = []
+    for img, boxes in dataset:
+        detector.detect(img)
+        times = []
+        for _ in range(repeat):
+            start = default_timer()
+            candies = detector.detect(img)
+            times.append(default_timer() - start)
+        latencies.append(np.median(times))
+
+        matched += score(candies, boxes)
+        n_detected += len(candies)
+        n_truth += len(boxes)
+
+    precision = matched / n_detected if n_detected else 0.0
+    recall = matched / n_truth if n_truth else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if matched else 0.0
+    return Trial(params, precision, recall, f1, float(np.mean(latencies)))
+
+
+def tune(dataset, params_list, processes=None, repeat=3):
+    """Evaluates each of params_list on the dataset in parallel processes."""
+    pool = Pool(processes, initializer=_init_worker, initargs=(dataset, repeat))
+    try:
+        return pool.map(_evaluate, params_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _init_worker(dataset, repeat):
+    # A single thread each, so that the latencies are of one core
+    global _dataset, _repeat
+    cv2.setNumThreads(1)
+    _dataset, _repeat = dataset, repeat
+
+
+def _evaluate(params):
+    return evaluate(params, _dataset, _repeat)
+
+
+def pareto_frontier(trials):
+    """Trials which no other trial is both faster and more accurate than, fastest first."""
+    frontier = []
+    for t in sorted(trials, key=lambda t: (t.latency, -t.f1)):
+        if not frontier or t.f1 > frontier[-1].f1:
+            frontier.append(t)
+    return frontier
+
+
+def config_block(params):
+    names = ['CANDY_DETECTOR_' + name.upper() for name in params]
+    width = max(len(n) for n in names)
+    return '\n'.join('    {} = {!r}'.format(n.ljust(width), _literal(v))
+                     for n, v in zip(names, params.values()))
+
+
+def _literal(value):
+    # As written in config.py
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, list):
+        return tuple(value)
+    return value
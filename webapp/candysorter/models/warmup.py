@@ -0,0 +1,140 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+import logging
+import threading
+from timeit import default_timer
+
+import cv2
+import numpy as np
+
+from candysorter.ext.google.cloud.language import Token
+
+logger = logging.getLogger(__name__)
+
+_TABLE_COLOR = 235
+
+
+class WarmUp(object):
+    """Runs synthetic inputs through the models, so that the first requests do not pay for it.
+
+    start() runs them in a thread, at startup and after the models are reloaded. It is ready once
+    the latest run has finished without errors. The Natural Language API is not called.
+
+    The detector keeps the buffers it allocates for the requests of any thread, as long as their
+    images are of the size of area.
+    """
+
+    def __init__(self, text_analyzer, candy_detector, candy_classifier, area=(1625, 1100),
+                 n_candies=10):
+        self.text_analyzer = text_analyzer
+        self.candy_detector = candy_detector
+        self.candy_classifier = candy_classifier
+        self.area = area
+        self.n_candies = n_candies
+
+        self.timings = OrderedDict()
+        self.errors = []
+        self._started = 0
+        self._finished = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        with self._lock:
+            return 0 < self._finished == self._started and not self.errors
+
+    @property
+    def running(self):
+        with self._lock:
+            return self._finished != self._started
+
+    def start(self):
+        with self._lock:
+            self._started += 1
+            run = self._started
+        thread = threading.Thread(target=self._run, args=(run,), name='warm-up-{}'.format(run))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self, run):
+        logger.info('Warming up the models...')
+        timings, errors = OrderedDict(), []
+
+        def _timed(name, func, *args):
+            start = default_timer()
+            try:
+                result = func(*args)
+            except Exception:
+                logger.exception('Failed to warm up %s.', name)
+                errors.append(name)
+                return None
+            timings[name] = default_timer() - start
+            return result
+
+        tokens = [_token(w.lower())
+                  for label in self.text_analyzer.labels for w in label.split(' ')]
+        for lang in sorted(self.text_analyzer.models or ['en']):
+            _timed('text_' + lang, self.text_analyzer.calc_similarities, tokens, lang)
+
+        img, boxes = _table_image(self.area, self.n_candies)
+        candies = _timed('detection', self.candy_detector.detect, img)
+        if candies:
+            crops = [c.cropped_img for c in candies]
+        else:
+            crops = [img[y0:y1, x0:x1] for x0, y0, x1, y1 in boxes]
+        _timed('classification', self.candy_classifier.warm_up, crops)
+
+        with self._lock:
+            if run == self._started:
+                self.timings, self.errors = timings, errors
+            self._finished = max(self._finished, run)
+        logger.info('Finished warming up the models: %s',
+                    ', '.join('{}={:.3f}s'.format(k, v) for k, v in timings.items()))
+
+
+def _token(word):
+    # As a noun of the Natural Language API
+    pos = dict.fromkeys(['aspect', 'case', 'form', 'gender', 'mood', 'number', 'person', 'proper',
+                         'reciprocity', 'tense', 'voice'], 'UNKNOWN')
+    pos['tag'] = 'NOUN'
+    return Token.from_api_repr({
+        'text': {'content': word, 'beginOffset': 0},
+        'partOfSpeech': pos,
+        'dependencyEdge': {'headTokenIndex': 0, 'label': 'ROOT'},
+        'lemma': word,
+    })
+
+
+def _table_image(area, n_candies, seed=0):
+    # Candies of random colors in a grid on the calibrated table, with the boxes of them
+    rng = np.random.RandomState(seed)
+    w, h = area
+    img = np.full((h, w, 3), _TABLE_COLOR, dtype=np.uint8)
+    cols = int(np.ceil(np.sqrt(n_candies * w / h)))
+    rows = int(np.ceil(n_candies / cols))
+    cw, ch = w // (cols + 1), h // (rows + 1)
+    boxes = []
+    for i in range(n_candies):
+        cx, cy = cw * (i % cols + 1), ch * (i // cols + 1)
+        axes = (int(cw * rng.uniform(0.2, 0.35)), int(ch * rng.uniform(0.15, 0.3)))
+        color = tuple(int(c) for c in rng.randint(0, 200, size=3))
+        cv2.ellipse(img, (cx, cy), axes, 0, 0, 360, color, -1)
+        boxes.append((cx - axes[0], cy - axes[1], cx + axes[0], cy + axes[1]))
+    return img, boxes
@@ -15,6 +15,7 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import atexit
 from datetime import datetime
 from functools import wraps
 import glob
@@ -37,9 +38,10 @@ from candysorter.config import Config
 from candysorter.ext.google.cloud.ml import State
 from candysorter.models.images.calibrate import ImageCalibrator
 from candysorter.models.images.classify import CandyClassifier
-from candysorter.models.images.detect import CandyDetector, detect_labels
-from candysorter.models.images.filter import exclude_unpickables
+from candysorter.models.images.detect import detect_labels
+from candysorter.models.images.filter import exclude_unpickables, pickable_mask
 from candysorter.models.images.train import CandyTrainer
+from candysorter.models.warmup import WarmUp
 from candysorter.utils import load_class, random_str, symlink_force
 
 logger = logging.getLogger(__name__)
@@ -53,23 +55,25 @@ candy_classifier = None
 candy_trainer = None
 image_capture = None
 image_calibrator = None
+warm_up = None
 
 
 @api.record
 def record(state):
+    # First, so that its feature workers are forked before word2vec is loaded
+    global candy_classifier
+    candy_classifier = CandyClassifier.from_config(Config)
+    candy_classifier.init()
+
     global text_analyzer
     text_analyzer = load_class(Config.CLASS_TEXT_ANALYZER).from_config(Config)
     text_analyzer.init()
 
     global candy_detector
-    candy_detector = CandyDetector.from_config(Config)
-
-    global candy_classifier
-    candy_classifier = CandyClassifier.from_config(Config)
-    candy_classifier.init()
+    candy_detector = load_class(Config.CLASS_CANDY_DETECTOR).from_config(Config)
 
     global candy_trainer
-    candy_trainer = CandyTrainer.from_config(Config)
+    candy_trainer = CandyTrainer.from_config(Config, feature_extractor=candy_classifier)
 
     global image_capture
     image_capture = load_class(Config.CLASS_IMAGE_CAPTURE).from_config(Config)
@@ -77,6 +81,15 @@ def record(state):
     global image_calibrator
     image_calibrator = ImageCalibrator.from_config(Config)
 
+    candy_detector.set_reach(pickable_mask(image_calibrator), Config.CANDY_DETECTOR_REACH_MARGIN)
+
+    global warm_up
+    warm_up = WarmUp(text_analyzer, candy_detector, candy_classifier,
+                     area=Config.IMAGE_CALIBRATOR_AREA)
+    warm_up.start()
+
+    atexit.register(_close_models)
+
 
 @api.errorhandler(400)
 def handle_http_error(e):
@@ -179,7 +192,8 @@ def similarities():
 
     # Calculate candy similarities
     logger.info('Calculating candy similarities.')
-    candy_sims = [candy_classifier.classify(c.cropped_img) for c in candies]
+    candy_sims = candy_classifier.classify_batch([c.cropped_img for c in candies])
+    logger.info('  Feature cache: %s', candy_classifier.feature_cache)
 
     # Reduce dimension
     logger.info('Reducing dimension.')
@@ -192,8 +206,7 @@ def similarities():
 
     # Save pickup point
     logger.info('Saving pickup point.')
-    nearest_centroid = candies[nearest_idx].box_centroid
-    pickup_point = image_calibrator.get_coordinate(nearest_centroid[0], nearest_centroid[1])
+    pickup_point = tuple(candies.coordinates(image_calibrator)[nearest_idx].tolist())
     cache.set('pickup_point', pickup_point)
 
     # For json
@@ -204,9 +217,7 @@ def similarities():
     def _coords_as_json(rsim):
         return list(rsim)
 
-    def _box_as_json(box_coords):
-        return [[x.astype(int), y.astype(int)] for x, y in box_coords]
-
+    candy_json = candies.to_json()
     return jsonify(similarities=dict(
         force=_sim_as_json(speech_sim),
         url=snapshot_url,
@@ -214,13 +225,13 @@ def similarities():
             dict(url=url,
                  similarities=_sim_as_json(sim),
                  coords=_coords_as_json(rsim),
-                 box=_box_as_json(candy.box_coords))
-            for candy, sim, rsim, url in zip(candies, candy_sims, candy_rsims, candy_urls)
+                 box=candy['box'])
+            for candy, sim, rsim, url in zip(candy_json, candy_sims, candy_rsims, candy_urls)
         ],
         nearest=dict(url=candy_urls[nearest_idx],
                      similarities=_sim_as_json(candy_sims[nearest_idx]),
                      coords=_coords_as_json(candy_rsims[nearest_idx]),
-                     box=_box_as_json(candies[nearest_idx].box_coords)),
+                     box=candy_json[nearest_idx]['box']),
     ))
 
 
@@ -387,8 +398,7 @@ def status():
             logger.info('Training completed, updating model: job_id=%s', job_id)
             new_checkpoint_dir = candy_trainer.download_checkpoints(job_id)
             symlink_force(os.path.basename(new_checkpoint_dir), Config.CLASSIFIER_MODEL_DIR)
-            text_analyzer.reload()
-            candy_classifier.reload()
+            _reload_models()
             cache.set(key, True)
 
     return jsonify(status=status, loss=losses, embedded=embedded)
@@ -399,10 +409,17 @@ def labels():
     return jsonify(labels=text_analyzer.labels)
 
 
+@api.route('/_ready')
+def ready():
+    # 503 until the models have been warmed up, at startup and after every reload
+    is_ready = warm_up.ready
+    return jsonify(ready=is_ready, running=warm_up.running, timings=warm_up.timings,
+                   errors=warm_up.errors), 200 if is_ready else 503
+
+
 @api.route('/_reload', methods=['POST'])
 def reload():
-    text_analyzer.reload()
-    candy_classifier.reload()
+    _reload_models()
     return jsonify({})
 
 
@@ -410,9 +427,33 @@ def reload():
 def reset():
     symlink_force(os.path.basename(Config.CLASSIFIER_MODEL_DIR_INITIAL),
                   Config.CLASSIFIER_MODEL_DIR)
+    _reload_models()
+    return jsonify({})
+
+
+@api.route('/_learn_background', methods=['POST'])
+def learn_background():
+    # Call with the table empty, e.g. after the camera or the lighting has changed
+    if not hasattr(candy_detector, 'learn'):
+        abort(400)
+    imgs = [_capture_image() for _ in range(Config.CANDY_DETECTOR_BG_FRAMES)]
+    candy_detector.learn(imgs)
+    # /capture detects candies below the label area of the rotated image
+    candy_detector.learn([ndimage.rotate(img, -90)[Config.TRAIN_LABEL_AREA_HEIGHT:]
+                          for img in imgs])
+    return jsonify({})
+
+
+def _reload_models():
     text_analyzer.reload()
     candy_classifier.reload()
-    return jsonify({})
+    warm_up.start()
+
+
+def _close_models():
+    # The feature workers and the thread pool of the detector
+    candy_classifier.close()
+    candy_detector.close()
 
 
 def _session_id():
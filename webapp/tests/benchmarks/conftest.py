@@ -0,0 +1,70 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import pytest
+
+from candysorter.config import get_config
+
+_peak_memories = []
+
+
+@pytest.fixture(scope='session')
+def config():
+    return get_config('dev')
+
+
+@pytest.fixture
+def peak_memory(request, benchmark):
+    """Measures the growth of the peak resident memory while calling a function.
+
+    The function is called once before measuring, so that the result is the steady state
+    memory of repeated calls, e.g. without the buffers allocated on the first call.
+    """
+    def _peak_memory(func, *args, **kwargs):
+        func(*args, **kwargs)
+        kb = _measure_peak_memory(func, *args, **kwargs)
+        benchmark.extra_info['peak_memory_kb'] = kb
+        _peak_memories.append((request.node.name, kb))
+        return kb
+    return _peak_memory
+
+
+def _measure_peak_memory(func, *args, **kwargs):
+    # Writing 5 to clear_refs resets VmHWM to the current VmRSS (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return None
+    rss = _read_status_kb('VmRSS')
+    func(*args, **kwargs)
+    return _read_status_kb('VmHWM') - rss
+
+
+def _read_status_kb(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _peak_memories:
+        return
+    terminalreporter.write_sep('-', 'peak memory growth (kB)')
+    for name, kb in _peak_memories:
+        terminalreporter.write_line('{:<80} {:>10}'.format(name, 'n/a' if kb is None else kb))
@@ -0,0 +1,97 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cv2
+import numpy as np
+
+_TABLE_COLOR = 235
+_MARKER_SIZE = 40
+
+_cache = {}
+
+
+def table_image(n_candies, size=(1625, 1100), touch=0.0, seed=0):
+    """Generates a calibrated table image with candies.
+
+    touch is the fraction of candies placed right next to another candy.
+    Returns the image and the rotated boxes ((cx, cy), (w, h), angle) of the candies.
+    """
+    key = (n_candies, tuple(size), touch, seed)
+    if key not in _cache:
+        _cache[key] = _table_image(n_candies, size, touch, seed)
+    img, boxes = _cache[key]
+    return img.copy(), list(boxes)
+
+
+def _table_image(n_candies, size, touch, seed):
+    rng = np.random.RandomState(seed)
+    w, h = size
+    img = np.full((h, w, 3), _TABLE_COLOR, dtype=np.uint8)
+    img += rng.randint(0, 3, img.shape).astype(np.uint8)
+
+    # Candies are scaled with the image, the defaults are for 1625x1100
+    s = w / 1625
+    boxes = []
+    for _ in range(n_candies * 200):
+        if len(boxes) == n_candies:
+            break
+        bw, bh = rng.randint(90, 180) * s, rng.randint(60, 120) * s
+        if boxes and rng.rand() < touch:
+            (px, py), (pw, _), _ = boxes[rng.randint(len(boxes))]
+            cx, cy = px + (pw + bw) / 2 - 5 * s, py
+        else:
+            cx, cy = rng.randint(120 * s, w - 120 * s), rng.randint(120 * s, h - 120 * s)
+        if not (100 * s < cx < w - 100 * s and 100 * s < cy < h - 100 * s):
+            continue
+        if any(abs(cx - x) < (bw + bw_) / 2 - 8 * s and abs(cy - y) < (bh + bh_) / 2 - 8 * s
+               for (x, y), (bw_, bh_), _ in boxes):
+            continue
+
+        box = ((cx, cy), (bw, bh), rng.uniform(-60, 60))
+        color = tuple(int(c) for c in rng.randint(20, 140, 3))
+        if rng.rand() < 0.5:
+            cv2.fillPoly(img, [np.int32(cv2.boxPoints(box))], color)
+        else:
+            cv2.ellipse(img, box, color, -1)
+        cv2.putText(img, 'AB', (int(cx - 20 * s), int(cy + 5 * s)), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.8 * s, (250, 250, 250), 2)
+        boxes.append(box)
+    return img, boxes
+
+
+def camera_image(table, frame_size=(1920, 1080), dictionary=cv2.aruco.DICT_6X6_250):
+    """Puts the table image into a camera frame with the markers at its corners."""
+    w, h = frame_size
+    th, tw = table.shape[:2]
+
+    # Corners of the table in the frame, in the order of the marker ids
+    qh = h - 4 * _MARKER_SIZE
+    qw = qh * tw / th
+    x1, y1 = (w - qw) / 2, _MARKER_SIZE
+    corners = np.float32([[x1, y1], [x1, y1 + qh], [x1 + qw, y1 + qh], [x1 + qw, y1]])
+
+    transform_matrix = cv2.getPerspectiveTransform(
+        np.float32([[0, 0], [0, th], [tw, th], [tw, 0]]), corners)
+    frame = cv2.warpPerspective(table, transform_matrix, (w, h),
+                                borderValue=(_TABLE_COLOR,) * 3)
+
+    # The top-left corner of each marker is the corner of the table
+    aruco_dict = cv2.aruco.Dictionary_get(dictionary)
+    for marker_id, (x, y) in enumerate(np.int32(corners)):
+        marker = cv2.aruco.drawMarker(aruco_dict, marker_id, _MARKER_SIZE)
+        frame[y:y + _MARKER_SIZE, x:x + _MARKER_SIZE] = marker[:, :, np.newaxis]
+    return frame
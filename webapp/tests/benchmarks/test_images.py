@@ -0,0 +1,125 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cv2
+import numpy as np
+import pytest
+
+from candysorter.models.images.calibrate import ImageCalibrator
+from candysorter.models.images.detect import (
+    _bounding_box_of, _crop_candy, _regions_of, CandyDetector
+)
+from candysorter.models.images.filter import exclude_unpickables
+from tests.benchmarks import scenes
+
+N_CANDIES = [5, 20, 40]
+SIZES = [(1625, 1100), (812, 550)]
+TOUCHES = [0.0, 0.5]
+
+
+def _detector(config, size):
+    # Smaller tables are detected with the parameters scaled to their resolution
+    detector = CandyDetector.from_config(config)
+    scale = size[0] / config.IMAGE_CALIBRATOR_AREA[0]
+    return detector if scale == 1 else detector._scaled(scale)
+
+
+def _regions(detector, img):
+    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    markers = detector._segment(img_gray)
+    regions = []
+    for _, window, mask in _regions_of(markers, start_label=2):
+        _, contours, _ = cv2.findContours(np.uint8(mask), cv2.RETR_EXTERNAL,
+                                          cv2.CHAIN_APPROX_SIMPLE,
+                                          offset=(window[1].start, window[0].start))
+        regions.append((window, mask, max(contours, key=cv2.contourArea)))
+    return regions
+
+
+@pytest.mark.parametrize('touch', TOUCHES)
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('n_candies', N_CANDIES)
+def test_detect(benchmark, peak_memory, config, n_candies, size, touch):
+    img, _ = scenes.table_image(n_candies, size=size, touch=touch)
+    detector = _detector(config, size)
+
+    peak_memory(detector.detect, img)
+    candies = benchmark(detector.detect, img)
+    benchmark.extra_info['candies'] = len(candies)
+
+
+@pytest.mark.parametrize('workers', [1, 2, 4, 8])
+def test_detect_tiled(benchmark, config, workers):
+    img, _ = scenes.table_image(25)
+    detector = CandyDetector.from_config(config)
+    detector.workers = workers
+
+    candies = benchmark(detector.detect, img)
+    benchmark.extra_info['candies'] = len(candies)
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('n_candies', N_CANDIES)
+def test_crop_candy(benchmark, peak_memory, config, n_candies, size):
+    img, _ = scenes.table_image(n_candies, size=size)
+    detector = _detector(config, size)
+    regions = [(window, mask) + _bounding_box_of(contour)
+               for window, mask, contour in _regions(detector, img)]
+
+    def _crop_all():
+        return [_crop_candy(img, *r, size=detector.crop_size) for r in regions]
+
+    peak_memory(_crop_all)
+    benchmark(_crop_all)
+    benchmark.extra_info['candies'] = len(regions)
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('n_candies', N_CANDIES)
+def test_bounding_box_of(benchmark, peak_memory, config, n_candies, size):
+    img, _ = scenes.table_image(n_candies, size=size)
+    detector = _detector(config, size)
+    contours = [contour for _, _, contour in _regions(detector, img)]
+
+    def _bounding_boxes():
+        return [_bounding_box_of(contour) for contour in contours]
+
+    peak_memory(_bounding_boxes)
+    benchmark(_bounding_boxes)
+    benchmark.extra_info['candies'] = len(contours)
+
+
+@pytest.mark.parametrize('n_candies', N_CANDIES)
+def test_calibrate(benchmark, peak_memory, config, n_candies):
+    table, _ = scenes.table_image(n_candies, size=config.IMAGE_CALIBRATOR_AREA)
+    img = scenes.camera_image(table, (config.IMAGE_CAPTURE_WIDTH, config.IMAGE_CAPTURE_HEIGHT))
+    calibrator = ImageCalibrator.from_config(config)
+
+    peak_memory(calibrator.calibrate, img)
+    calibrated = benchmark(calibrator.calibrate, img)
+    assert calibrated.shape[:2] == table.shape[:2]
+
+
+@pytest.mark.parametrize('n_candies', N_CANDIES)
+def test_exclude_unpickables(benchmark, peak_memory, config, n_candies):
+    img, _ = scenes.table_image(n_candies, size=config.IMAGE_CALIBRATOR_AREA)
+    candies = CandyDetector.from_config(config).detect(img)
+    calibrator = ImageCalibrator.from_config(config)
+
+    peak_memory(exclude_unpickables, calibrator, candies)
+    benchmark(exclude_unpickables, calibrator, candies)
+    benchmark.extra_info['candies'] = len(candies)
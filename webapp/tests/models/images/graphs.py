@@ -0,0 +1,64 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""A small graph of the structure of classify_image_graph_def.pb, for the tests of TensorFlow."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+
+def inception_graph_def(n_classes=10, seed=0):
+    """DecodeJpeg to ResizeBilinear of a batch of one, a convolution to pool_3 and a softmax.
+
+    As in inception-v3, ResizeBilinear has the static shape (1, 299, 299, 3) and pool_3 is
+    reshaped to [1, 2048].
+    """
+    rng = np.random.RandomState(seed)
+
+    def _const(shape, name, low=-1.0, high=1.0):
+        return tf.constant(rng.uniform(low, high, shape).astype(np.float32), name=name)
+
+    with tf.Graph().as_default() as graph:
+        _, jpeg = cv2.imencode('.jpg', np.full((32, 32, 3), 128, dtype=np.uint8))
+        contents = tf.constant(jpeg.tostring(), name='DecodeJpeg/contents')
+        img = tf.image.decode_jpeg(contents, channels=3, name='DecodeJpeg')
+        expanded = tf.expand_dims(tf.cast(img, tf.float32, name='Cast'), 0, name='ExpandDims')
+        resized = tf.image.resize_bilinear(
+            expanded, tf.constant([299, 299], name='ResizeBilinear/size'), name='ResizeBilinear')
+        normalized = tf.multiply(tf.subtract(resized, 128.0, name='Sub'), 1 / 128.0, name='Mul')
+
+        conv = tf.nn.conv2d(normalized, _const((8, 8, 3, 2048), 'conv/weights', -0.1, 0.1),
+                            [1, 8, 8, 1], 'VALID', name='conv/Conv2D')
+        bn = tf.nn.batch_norm_with_global_normalization(
+            conv, _const(2048, 'conv/mean', -0.1, 0.1), _const(2048, 'conv/variance', 0.5, 1.5),
+            _const(2048, 'conv/beta', 0.0, 0.5), _const(2048, 'conv/gamma', 0.5, 1.5), 0.001,
+            True, name='conv/batchnorm')
+        pool = tf.nn.avg_pool(tf.nn.relu(bn, name='conv/relu'), [1, 37, 37, 1], [1, 1, 1, 1],
+                              'VALID', name='pool_3')
+        features = tf.reshape(pool, [1, 2048], name='pool_3/_reshape')
+
+        logits = tf.matmul(features, _const((2048, n_classes), 'softmax/weights', -0.1, 0.1),
+                           name='softmax/logits/MatMul')
+        tf.nn.softmax(logits, name='softmax')
+    return graph.as_graph_def()
+
+
+def write_inception_graph(path, **kwargs):
+    with open(path, 'wb') as f:
+        f.write(inception_graph_def(**kwargs).SerializeToString())
+    return path
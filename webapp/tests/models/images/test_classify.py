@@ -0,0 +1,118 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from trainer.model import ModelParams, NumpyTransferModel, TransferModel  # noqa: E402
+
+from candysorter.models.images.classify import (  # noqa: E402
+    CandyClassifier, TransferPredictor
+)
+
+
+def _train_transfer_model(tmpdir, features_size=16, num_classes=4, hidden_size=8, seed=0,
+                          checkpoint=False):
+    # A few steps from the initial weights, so that the biases are no longer all ones
+    rng = np.random.RandomState(seed)
+    features = rng.uniform(0, 1, (32, features_size)).astype(np.float32)
+    label_ids = rng.randint(num_classes, size=32)
+    weights_file = str(tmpdir.join('weights.npz'))
+    params = ModelParams(labels=['label{}'.format(i) for i in range(num_classes)],
+                         features_size=features_size, hidden_size=hidden_size)
+    tmpdir.join('params.json').write(params.to_json())
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        model = TransferModel(features_size=features_size, num_classes=num_classes,
+                              hidden_size=hidden_size)
+        train_op = model.train_op(tf.train.GradientDescentOptimizer(0.5))
+        with tf.Session() as sess:
+            sess.run(tf.initialize_all_variables())
+            for _ in range(20):
+                sess.run(train_op, model.feed_for_training(features, label_ids, keep_prob=0.5))
+            if checkpoint:
+                model.saver.save(sess, str(tmpdir.join('model.ckpt')))
+            else:
+                model.export_weights(sess, weights_file)
+            expected = model.predict(sess, features)
+    return weights_file, features, expected
+
+
+def test_numpy_transfer_model(tmpdir):
+    weights_file, features, expected = _train_transfer_model(tmpdir)
+    model = NumpyTransferModel.load(weights_file)
+    assert model.hidden_weights.shape == (16, 8)
+    assert model.logits_weights.shape == (8, 4)
+    assert not np.allclose(model.logits_biases, 1)
+
+    actual = model.predict(features)
+    assert actual.shape == (32, 4)
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(model.predict(features[:1]), expected[:1], rtol=1e-5, atol=1e-6)
+
+
+def _classifier(checkpoint_dir):
+    # Only the transfer model, without loading inception
+    return CandyClassifier(checkpoint_dir=str(checkpoint_dir),
+                           params_file=str(checkpoint_dir.join('params.json')),
+                           inception_model_file=None)
+
+
+def _touch(path, seconds=10):
+    mtime = os.path.getmtime(str(path)) + seconds
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_reload_weights(tmpdir):
+    _, features, expected = _train_transfer_model(tmpdir)
+    classifier = _classifier(tmpdir)
+    predictor = classifier._transfer_predictor()
+    assert isinstance(predictor, NumpyTransferModel)
+    assert classifier._transfer_predictor() is predictor
+
+    _touch(tmpdir.join('weights.npz'))
+    reloaded = classifier._transfer_predictor()
+    assert reloaded is not predictor
+    assert classifier._transfer_predictor() is reloaded
+    np.testing.assert_allclose(classifier._predict(features), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_reload_checkpoint(tmpdir):
+    _, features, expected = _train_transfer_model(tmpdir, checkpoint=True)
+    classifier = _classifier(tmpdir)
+    predictor = classifier._transfer_predictor()
+    assert isinstance(predictor, TransferPredictor)
+    assert classifier._transfer_predictor() is predictor
+    np.testing.assert_allclose(classifier._predict(features), expected, rtol=1e-5, atol=1e-6)
+
+    # The replaced one is closed
+    _touch(tmpdir.join('checkpoint'))
+    reloaded = classifier._transfer_predictor()
+    assert reloaded is not predictor
+    assert predictor.sess is None
+    assert reloaded.sess is not None
+    assert classifier._transfer_predictor() is reloaded
+    with pytest.raises(RuntimeError):
+        predictor.predict(features)
+    np.testing.assert_allclose(classifier._predict(features), expected, rtol=1e-5, atol=1e-6)
+
+    classifier.close()
+    assert reloaded.sess is None
@@ -0,0 +1,447 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+import pytest
+
+from candysorter.config import get_config
+from candysorter.models.images import detect, tune
+from candysorter.models.images.detect import (
+    _remove_small_components, _restore_foreground, BackgroundCandyDetector, Candy, CandyDetector,
+    CandySet, DetectorWorkspace
+)
+from tests.benchmarks.scenes import table_image
+
+
+def _blobs(seed, shape=(400, 600), n=60):
+    rng = np.random.RandomState(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(n):
+        center = (rng.randint(0, shape[1]), rng.randint(0, shape[0]))
+        axes = (rng.randint(2, 40), rng.randint(2, 40))
+        cv2.ellipse(mask, center, axes, rng.randint(0, 180), 0, 360, 255, -1)
+    return mask
+
+
+def _remove_small_components_by_loop(bg, bg_size_filter):
+    n, markers_bg, sizes, cogs = cv2.connectedComponentsWithStats(bg)
+    sizes = sizes.take(4, axis=1)
+    sure_bg = bg.copy()
+    for i in range(1, n):
+        if sizes[i] < bg_size_filter:
+            sure_bg -= (markers_bg == i).astype(np.uint8) * 255
+    return sure_bg
+
+
+def _restore_foreground_by_loop(fg, eroded, restore_fg_thres):
+    _, markers_eroded = cv2.connectedComponents(eroded)
+
+    oids_eroded, counts_eroded = np.unique(markers_eroded, return_counts=True)
+    oids_fg, counts_fg = np.unique(markers_eroded * (fg > 0), return_counts=True)
+
+    temp = np.array([
+        counts_fg[np.where(oids_fg == oid)[0][0]] if oid in oids_fg else 0
+        for oid in oids_eroded
+    ])
+    oids_sure_fg = oids_eroded[
+        (oids_eroded > 0) & ~(1.0 * temp / counts_eroded > restore_fg_thres)
+    ]
+    sure_fg = np.bool_(fg)
+    for oid in oids_sure_fg:
+        sure_fg = np.logical_or(sure_fg, markers_eroded == oid)
+    return 255 * np.uint8(sure_fg)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('min_size', [0, 50, 500, 2000])
+def test_remove_small_components(seed, min_size):
+    bg = _blobs(seed)
+    expected = _remove_small_components_by_loop(bg, min_size)
+    actual = _remove_small_components(bg, min_size)
+    assert actual.dtype == expected.dtype
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('fg_thres', [3, 10, 20])
+@pytest.mark.parametrize('restore_thres', [0.0, 0.05, 0.3])
+def test_restore_foreground(seed, fg_thres, restore_thres):
+    eroded = _blobs(seed)
+    dist = cv2.distanceTransform(eroded, cv2.DIST_L2, 5)
+    _, fg = cv2.threshold(dist, fg_thres, 255, cv2.THRESH_BINARY)
+    fg = np.uint8(fg)
+
+    expected = _restore_foreground_by_loop(fg, eroded, restore_thres)
+    actual = _restore_foreground(fg, eroded, restore_thres)
+    assert actual.dtype == expected.dtype
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'scale': 0.5}, {'workers': 2}])
+def test_detect_metrics(kwargs):
+    img, _ = table_image(10)
+    expected = CandyDetector(**kwargs).detect(img)
+
+    metrics = []
+    actual = CandyDetector(metrics_hook=metrics.append, **kwargs).detect(img)
+    assert len(metrics) == 1
+    assert metrics[0].counts['candies'] == len(actual) == len(expected)
+    assert metrics[0].counts['components'] >= len(actual)
+    for stage in ['histogram', 'binarize', 'edge3', 'edge5', 'closing', 'opening', 'sure_bg',
+                  'distance_transform', 'restore_fg', 'labelling']:
+        assert metrics[0].stages[stage] >= 0
+    assert sorted(c.box_centroid for c in actual) == sorted(c.box_centroid for c in expected)
+
+
+@pytest.mark.parametrize('touch', [0.0, 0.5])
+def test_detect_pyramid_accuracy(touch):
+    full = CandyDetector.from_config(get_config('dev'))
+    pyramid = CandyDetector.from_config(get_config('dev'))
+    pyramid.scale = 0.5
+
+    def _score(candies, boxes):
+        return tune.score(candies, [np.float32(cv2.boxPoints(box)) for box in boxes])
+
+    matched = {full: 0, pyramid: 0}
+    detected = {full: 0, pyramid: 0}
+    n_truth, n_same, centroid_errors, dims_errors = 0, 0, [], []
+    for seed in range(4):
+        img, boxes = table_image(20, touch=touch, seed=seed)
+        n_truth += len(boxes)
+        candies = {}
+        for detector in [full, pyramid]:
+            candies[detector] = detector.detect(img)
+            matched[detector] += _score(candies[detector], boxes)
+            detected[detector] += len(candies[detector])
+
+        # The candies of the full resolution with one of the pyramid within 10 px
+        for c in candies[full]:
+            distances = np.hypot(*(candies[pyramid].box_centroids - c.box_centroid).T)
+            i = int(np.argmin(distances))
+            if distances[i] < 10:
+                n_same += 1
+                centroid_errors.append(distances[i])
+                dims_errors.append(np.abs(np.sort(candies[pyramid][i].box_dims) -
+                                          np.sort(c.box_dims)).max())
+
+    # As accurate on the drawn candies as the full resolution
+    assert matched[pyramid] / n_truth >= matched[full] / n_truth - 0.05
+    assert matched[pyramid] / detected[pyramid] >= matched[full] / detected[full] - 0.05
+    # and most candies of the full resolution are found at about the same box
+    assert n_same >= 0.65 * detected[full]
+    assert np.mean(centroid_errors) < 2
+    assert np.median(dims_errors) < 1
+    assert np.mean(dims_errors) < 3
+
+
+def test_detect_pyramid_reuses_workspaces(monkeypatch):
+    img, _ = table_image(20)
+    detector = CandyDetector(scale=0.5)
+    expected = detector.detect(img)
+
+    # The ROIs are refined in the buffers of the workspace of the first call
+    allocated = []
+    init = DetectorWorkspace.__init__
+    monkeypatch.setattr(DetectorWorkspace, '__init__',
+                        lambda self, shape: allocated.append(shape) or init(self, shape))
+    candies = detector.detect(img)
+    assert allocated == []
+    assert candies.to_json() == expected.to_json()
+
+
+def test_detect_tiled_shares_pool(monkeypatch):
+    img, _ = table_image(10)
+    detector = CandyDetector(workers=2)
+    expected = detector.detect(img).to_json()
+    detector.close()
+
+    # One pool for the concurrent requests, started again after close()
+    pools = []
+    monkeypatch.setattr(detect, 'ThreadPool', lambda n: pools.append(ThreadPool(n)) or pools[-1])
+    requests = ThreadPool(4)
+    results = requests.map(lambda _: detector.detect(img).to_json(), range(8))
+    requests.close()
+    assert len(pools) == 1
+    assert all(r == expected for r in results)
+
+    detector.close()
+    assert detector.detect(img).to_json() == expected
+    assert len(pools) == 2
+    detector.close()
+
+
+def _seam_image():
+    # Candies centered on the seams of the cores of 2, 4 and 8 tiles and on their crossings,
+    # and two touching candies across the middle seam
+    img, _ = table_image(0)
+    h, w = img.shape[:2]
+    centers = set()
+    for n in [2, 4, 8]:
+        for (y1, x1, y2, x2), _ in detect._tiles_of((h, w), n, 200):
+            centers.update(p for p in [(x1, (y1 + y2) // 2), ((x1 + x2) // 2, y1), (x1, y1)]
+                           if 150 < p[0] < w - 150 and 150 < p[1] < h - 150)
+    rng = np.random.RandomState(0)
+    boxes = [(c, (130, 90), rng.uniform(-60, 60)) for c in sorted(centers)]
+    boxes += [((747, 690), (130, 90), 0), ((877, 690), (130, 90), 0)]
+    for box in boxes:
+        color = tuple(int(c) for c in rng.randint(20, 140, 3))
+        cv2.fillPoly(img, [np.int32(cv2.boxPoints(box))], color)
+    return img, sorted(centers)
+
+
+@pytest.mark.parametrize('workers', [2, 4, 8])
+def test_detect_tiled_seams(workers):
+    img, centers = _seam_image()
+    config = get_config('dev')
+    expected = CandyDetector.from_config(config).detect(img)
+
+    detector = CandyDetector.from_config(config)
+    detector.workers = workers
+    candies = detector.detect(img)
+    detector.close()
+
+    # Neither duplicated nor cut by the seams
+    assert (sorted(zip(candies.box_centroids.tolist(), candies.box_dims.tolist())) ==
+            sorted(zip(expected.box_centroids.tolist(), expected.box_dims.tolist())))
+    for x, y in centers:
+        distances = np.hypot(*(candies.box_centroids - (x, y)).T)
+        assert distances.min() < 5
+        assert sorted(candies.box_dims[distances.argmin()]) == pytest.approx([100, 140], abs=10)
+
+
+def test_candy_cropped_lazily():
+    img, _ = table_image(10)
+    expected = [c.cropped_img for c in CandyDetector().detect(img)]
+
+    candies = CandyDetector().detect(img)
+    assert all(c._cropped_img is None for c in candies)
+    for c, e in zip(candies, expected):
+        assert np.array_equal(c.cropped_img, e)
+        assert c.cropped_img is c.cropped_img
+
+
+def test_crop_size():
+    img, _ = table_image(20)
+    full = CandyDetector().detect(img)
+    fixed = CandyDetector(crop_size=299).detect(img)
+    assert fixed.to_json() == full.to_json()
+
+    # The same as resizing the crop of the candy to the input of inception-v3, but for the
+    # rounding at the edges of the mask
+    for f, c in zip(full, fixed):
+        assert c.cropped_img.shape == (299, 299, 3)
+        resized = cv2.resize(f.cropped_img, (299, 299), interpolation=cv2.INTER_LINEAR)
+        diff = np.abs(c.cropped_img.astype(int) - resized)
+        assert diff.mean() < 3
+        assert (diff > 40).mean() < 0.03
+
+
+def test_candies_of_fragmented_label():
+    img = np.full((300, 400, 3), 200, dtype=np.uint8)
+    markers = np.ones((300, 400), dtype=np.int32)
+    # A label of a large fragment above a small one
+    markers[50:130, 100:220] = 2
+    markers[200:240, 250:290] = 2
+    large = np.zeros(markers.shape, dtype=np.bool_)
+    large[50:130, 100:220] = True
+
+    # By default the first contour found, which is the small one, with the mask of both
+    candies = CandyDetector(box_dim_thres=10)._candies_of(img, markers)
+    assert len(candies) == 1
+    assert tuple(candies[0].box_centroid) == pytest.approx((269.5, 219.5), abs=1)
+    assert sorted(candies[0].box_dims) == pytest.approx([39, 39], abs=1)
+    _, window, mask = candies[0]._crop.args[:3]
+    assert np.array_equal(mask, (markers == 2)[window])
+
+    # The large fragment, and the crop masked by it only
+    candies = CandyDetector(box_dim_thres=10, largest_fragment=True)._candies_of(img, markers)
+    assert len(candies) == 1
+    assert tuple(candies[0].box_centroid) == pytest.approx((159.5, 89.5), abs=1)
+    assert sorted(candies[0].box_dims) == pytest.approx([79, 119], abs=1)
+    _, window, mask = candies[0]._crop.args[:3]
+    assert np.array_equal(mask, large[window])
+
+
+def test_candy_set():
+    img, _ = table_image(10)
+    candies = CandyDetector().detect(img)
+    assert isinstance(candies, CandySet)
+    assert len(candies) == len(list(candies)) > 0
+    assert candies.box_coords.shape == (len(candies), 4, 2)
+
+    # The same candies as a list of them
+    listed = CandySet.of([Candy(c.box_coords, c.box_dims, c.box_centroid) for c in candies])
+    for c, l in zip(candies, listed):
+        assert (c.box_coords, c.box_dims, c.box_centroid) == (l.box_coords, l.box_dims,
+                                                              l.box_centroid)
+    assert candies.to_json() == listed.to_json()
+    assert candies.to_json()[0]['box'] == [[int(x), int(y)] for x, y in candies[0].box_coords]
+
+    # Subsets crop each candy only once
+    xs = candies.box_centroids[:, 0]
+    left = candies[xs < np.median(xs)]
+    assert 0 < len(left) < len(candies)
+    assert left[0].cropped_img is candies[np.argmax(xs < np.median(xs))].cropped_img
+
+    ordered = candies.sorted_by(xs)
+    assert [c.box_centroid for c in ordered] == sorted(c.box_centroid for c in candies)
+    assert len(candies[[]]) == 0
+    assert len(candies + left) == len(candies) + len(left)
+
+
+class _Spy(object):
+    # Counts the calls of a method of a detector
+    def __init__(self, monkeypatch, detector, name):
+        self.calls = 0
+        method = getattr(detector, name)
+
+        def _call(*args, **kwargs):
+            self.calls += 1
+            return method(*args, **kwargs)
+        monkeypatch.setattr(detector, name, _call)
+
+
+def _removed(img, box, empty):
+    # The candy of box taken away from the table
+    (cx, cy), (w, h), _ = box
+    r = int(max(w, h) / 2) + 20
+    img = img.copy()
+    img[int(cy) - r:int(cy) + r, int(cx) - r:int(cx) + r] = \
+        empty[int(cy) - r:int(cy) + r, int(cx) - r:int(cx) + r]
+    return img
+
+
+def test_detect_stream_unchanged(monkeypatch):
+    img, _ = table_image(20)
+    detector = CandyDetector()
+    detect = _Spy(monkeypatch, detector, 'detect')
+    segment = _Spy(monkeypatch, detector, '_segment')
+
+    first, second = list(detector.detect_stream([img, img.copy()]))
+    assert second is first
+    assert (detect.calls, segment.calls) == (1, 1)
+
+
+def test_detect_stream_changed_region(monkeypatch):
+    img, boxes = table_image(20)
+    changed = _removed(img, boxes[0], table_image(0)[0])
+    detector = CandyDetector()
+    detect = _Spy(monkeypatch, detector, 'detect')
+    redetect = _Spy(monkeypatch, detector, '_redetect')
+
+    first, second = list(detector.detect_stream([img, changed]))
+    assert (detect.calls, redetect.calls) == (1, 1)
+    assert len(second) == len(first) - 1
+
+    expected = CandyDetector().detect(changed)
+    assert (sorted(map(sorted, c.items()) for c in second.to_json()) ==
+            sorted(map(sorted, c.items()) for c in expected.to_json()))
+    for c in second:
+        e = expected[[c.box_centroid == e.box_centroid for e in expected].index(True)]
+        assert np.array_equal(c.cropped_img, e.cropped_img)
+
+
+def test_detect_stream_slow_change(monkeypatch):
+    # The candy fades away by less than diff_thres a frame, but more in total
+    img, boxes = table_image(20)
+    changed = _removed(img, boxes[0], table_image(0)[0])
+    frames = [cv2.addWeighted(img, 1 - k / 4, changed, k / 4, 0) for k in range(5)]
+    grays = [cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) for f in frames]
+    assert all(cv2.absdiff(a, b).max() < 30 for a, b in zip(grays, grays[1:]))
+    detector = CandyDetector()
+    detect = _Spy(monkeypatch, detector, 'detect')
+    redetect = _Spy(monkeypatch, detector, '_redetect')
+
+    # Segmented again when it has changed by diff_thres from the frame it was segmented in
+    candies = list(detector.detect_stream(frames, diff_thres=30))
+    assert (detect.calls, redetect.calls) == (1, 2)
+    assert candies[1] is candies[0]
+    assert candies[3] is candies[2]
+    assert len(candies[-1]) == len(candies[0]) - 1
+    expected = CandyDetector().detect(changed)
+    assert (sorted(map(sorted, c.items()) for c in candies[-1].to_json()) ==
+            sorted(map(sorted, c.items()) for c in expected.to_json()))
+
+
+def test_detect_stream_large_change(monkeypatch):
+    # The lighting changed, so the whole frame is over diff_thres
+    img, _ = table_image(20)
+    darker = cv2.subtract(img, np.full_like(img, 40))
+    detector = CandyDetector()
+    detect = _Spy(monkeypatch, detector, 'detect')
+    redetect = _Spy(monkeypatch, detector, '_redetect')
+
+    first, second = list(detector.detect_stream([img, darker], diff_thres=30))
+    assert (detect.calls, redetect.calls) == (2, 0)
+    assert second.to_json() == CandyDetector().detect(darker).to_json()
+
+
+@pytest.mark.parametrize('touch', [0.0, 0.5])
+def test_fast_path_watershed_for_all_blobs(touch):
+    # Every blob is a cluster, so it is the same segmentation only inside a window
+    img, _ = table_image(20, touch=touch)
+    expected = CandyDetector().detect(img)
+    actual = CandyDetector(solidity_thres=1.01).detect(img)
+    assert (sorted((c.box_centroid, c.box_dims) for c in actual) ==
+            sorted((c.box_centroid, c.box_dims) for c in expected))
+
+
+@pytest.mark.parametrize('touch', [0.0, 0.5])
+def test_fast_path_one_candy_per_blob(touch):
+    img, _ = table_image(20, touch=touch)
+    metrics = []
+    candies = CandyDetector(solidity_thres=0.0, metrics_hook=metrics.append).detect(img)
+    assert metrics[0].counts['clusters'] == 0
+    assert metrics[0].counts['components'] == metrics[0].counts['isolated']
+    assert 0 < len(candies) <= metrics[0].counts['isolated']
+    assert 'distance_transform' not in metrics[0].stages
+
+
+def test_background_detector():
+    img, boxes = table_image(20)
+    detector = BackgroundCandyDetector.from_config(get_config('dev'))
+    # The first contour of a label of several fragments is often a small one
+    detector.largest_fragment = True
+    detector.learn([table_image(0, seed=i)[0] for i in range(1, 4)])
+
+    # Every candy is on a candy of the scene, but overlapping candies are found as one
+    candies = detector.detect(img)
+    for c in candies:
+        assert any(cv2.pointPolygonTest(np.float32(cv2.boxPoints(box)), c.box_centroid, True) > -10
+                   for box in boxes)
+    distances = np.array([[np.hypot(x - cx, y - cy) for (cx, cy), _, _ in boxes]
+                          for x, y in [c.box_centroid for c in candies]])
+    assert (distances.min(axis=0) < 20).sum() >= 0.75 * len(boxes)
+
+    # Each tile is compared with its part of the background
+    tiled = BackgroundCandyDetector.from_config(get_config('dev'))
+    tiled.workers = 2
+    tiled.largest_fragment = True
+    tiled.backgrounds = detector.backgrounds
+    assert (sorted(c.box_centroid for c in tiled.detect(img)) ==
+            sorted(c.box_centroid for c in candies))
+
+    assert len(detector.detect(table_image(0, seed=4)[0])) == 0
+
+
+def test_background_detector_without_background():
+    img, _ = table_image(10)
+    assert ([c.box_centroid for c in BackgroundCandyDetector().detect(img)] ==
+            [c.box_centroid for c in CandyDetector().detect(img)])
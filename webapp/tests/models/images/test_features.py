@@ -0,0 +1,253 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from candysorter.models.images import features
+from candysorter.models.images.features import FeatureCache, FeaturePool
+
+
+class _Extractor(object):
+    def __init__(self):
+        self.extracted = 0
+
+    def __call__(self, imgs):
+        self.extracted += len(imgs)
+        vectors = [[img.mean(), img.std()] + [0] * 2046 for img in imgs]
+        return np.float32(vectors).reshape(-1, 2048)
+
+
+class _Inception(_Extractor):
+    # As FeatureExtractor, in the workers of FeaturePool
+    def __init__(self, model_file):
+        super(_Inception, self).__init__()
+        if not os.path.isfile(model_file):
+            raise IOError('{} not found.'.format(model_file))
+
+    def get_feature_vectors(self, imgs):
+        if any(img.ndim != 3 for img in imgs):
+            raise ValueError('Not a BGR image.')
+        return self(imgs)
+
+    def get_feature_vectors_from_files(self, image_paths):
+        return list(self.get_feature_vectors([cv2.imread(p) for p in image_paths]))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def model_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(features, '_load_extractor', lambda model_file, *_: _Inception(model_file))
+    model_file = tmpdir.join('classify_image_graph_def.pb')
+    model_file.write('model')
+    return str(model_file)
+
+
+def _crops(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randint(0, 256, (40 + i, 60, 3)).astype(np.uint8) for i in range(n)]
+
+
+@pytest.mark.parametrize('hash_tolerance', [None, 0, 4])
+def test_feature_cache(hash_tolerance):
+    extract = _Extractor()
+    cache = FeatureCache(max_bytes=10 * 2048 * 4, hash_tolerance=hash_tolerance)
+    crops = _crops(6)
+    expected = extract(crops)
+
+    assert np.array_equal(cache.get_feature_vectors(crops, extract), expected)
+    assert (cache.hits, cache.misses, extract.extracted) == (0, 6, 12)
+    # The same crops in other arrays
+    assert np.array_equal(cache.get_feature_vectors([c.copy() for c in crops[::-1]], extract),
+                          expected[::-1])
+    assert (cache.hits, cache.misses, extract.extracted) == (6, 6, 12)
+    assert cache.bytes == 6 * 2048 * 4
+
+    # Least recently used first, which are the last crops
+    cache.get_feature_vectors(_crops(6, seed=1), extract)
+    assert (len(cache), cache.evictions) == (10, 2)
+    cache.get_feature_vectors(crops[:4], extract)
+    assert cache.misses == 12
+    cache.get_feature_vectors(crops[4:], extract)
+    assert cache.misses == 12 + 2
+
+    assert cache.get_feature_vectors([], extract).shape == (0, 2048)
+
+
+def test_feature_cache_tolerance():
+    extract = _Extractor()
+    crop = _crops(1)[0]
+    noisy = np.clip(crop.astype(int) + np.random.RandomState(1).randint(-2, 3, crop.shape), 0,
+                    255).astype(np.uint8)
+
+    exact = FeatureCache()
+    exact.get_feature_vectors([crop], extract)
+    exact.get_feature_vectors([noisy], extract)
+    assert exact.hits == 0
+
+    tolerant = FeatureCache(hash_tolerance=8)
+    tolerant.get_feature_vectors([crop], extract)
+    assert np.array_equal(tolerant.get_feature_vectors([noisy], extract), extract([crop]))
+    assert tolerant.hits == 1
+
+
+def test_feature_cache_backbone(tmpdir):
+    extract = _Extractor()
+    model_file = tmpdir.join('classify_image_graph_def.pb')
+    model_file.write('model')
+    cache = FeatureCache()
+    cache.set_backbone(str(model_file))
+    cache.get_feature_vectors(_crops(3), extract)
+
+    # Loaded again, or the transfer model trained again
+    cache.set_backbone(str(model_file))
+    assert len(cache) == 3
+
+    model_file.write('another model')
+    cache.set_backbone(str(model_file))
+    assert (len(cache), cache.bytes) == (0, 0)
+
+
+def test_feature_cache_disabled():
+    extract = _Extractor()
+    cache = FeatureCache(max_bytes=0)
+    cache.get_feature_vectors(_crops(3), extract)
+    cache.get_feature_vectors(_crops(3), extract)
+    assert (len(cache), extract.extracted) == (0, 6)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_feature_pool(model_file, processes):
+    crops = _crops(20)
+    expected = _Extractor()(crops)
+
+    # A buffer of 3 crops at most
+    with FeaturePool(model_file, processes=processes, buffer_bytes=3 * 60 * 60 * 3) as pool:
+        assert len(pool._chunks([c.nbytes for c in crops])) >= 7
+        assert np.array_equal(pool.get_feature_vectors(crops), expected)
+        assert pool.get_feature_vectors([]).shape == (0, 2048)
+
+        threads = ThreadPool(4)
+        results = threads.map(lambda i: pool.get_feature_vectors(crops[i:]), range(8))
+        threads.close()
+        for i, result in enumerate(results):
+            assert np.array_equal(result, expected[i:])
+
+        with pytest.raises(ValueError):
+            pool.get_feature_vectors([np.zeros((200, 200, 3), dtype=np.uint8)])
+    with pytest.raises(RuntimeError):
+        pool.get_feature_vectors(crops)
+
+
+def test_feature_pool_files(model_file, tmpdir):
+    crops = _crops(5)
+    paths = []
+    for i, crop in enumerate(crops):
+        paths.append(str(tmpdir.join('{}.png'.format(i))))
+        cv2.imwrite(paths[-1], crop)
+
+    with FeaturePool(model_file, buffer_bytes=2 * 2048 * 4) as pool:
+        vectors = pool.get_feature_vectors_from_files(paths)
+    assert len(vectors) == 5
+    assert np.array_equal(np.stack(vectors), _Extractor()(crops))
+
+
+def test_feature_pool_errors(model_file):
+    with pytest.raises(RuntimeError, match='not found'):
+        FeaturePool(model_file + '.missing')
+
+    with FeaturePool(model_file) as pool:
+        with pytest.raises(RuntimeError, match='Not a BGR image'):
+            pool.get_feature_vectors([np.zeros((40, 60), dtype=np.uint8)])
+        # Still working
+        assert pool.get_feature_vectors(_crops(2)).shape == (2, 2048)
+
+
+def test_feature_pool_close(model_file):
+    pool = FeaturePool(model_file)
+    worker = pool._free.get()
+    errors = []
+
+    def _extract():
+        try:
+            pool.get_feature_vectors(_crops(1))
+        except RuntimeError as e:
+            errors.append(e)
+
+    # A call waiting for the busy worker, and closes from two threads
+    threads = [threading.Thread(target=f) for f in [_extract, pool.close, pool.close]]
+    for t in threads:
+        t.start()
+    while not pool._closed:
+        time.sleep(0.01)
+    pool._free.put(worker)
+    for t in threads:
+        t.join(10)
+        assert not t.is_alive()
+    assert len(errors) == 1
+    assert not pool.alive
+
+
+def test_feature_pool_alive(model_file):
+    with FeaturePool(model_file, processes=2) as pool:
+        assert pool.alive
+        pool._workers[1].process.terminate()
+        pool._workers[1].process.join()
+        assert not pool.alive
+
+
+def test_classifier_reload(model_file, tmpdir):
+    pytest.importorskip('tensorflow')
+    from candysorter.models.images.classify import CandyClassifier
+
+    rng = np.random.RandomState(0)
+    np.savez(str(tmpdir.join('weights.npz')), hidden_weights=rng.randn(2048, 8),
+             hidden_biases=np.zeros(8), logits_weights=rng.randn(8, 2), logits_biases=np.zeros(2))
+    classifier = CandyClassifier(checkpoint_dir=str(tmpdir),
+                                 params_file=str(tmpdir.join('params.json')),
+                                 inception_model_file=model_file, feature_processes=1)
+    classifier.init()
+    try:
+        pool = classifier.inception_model
+        classifier.reload()
+        assert classifier.inception_model is pool
+
+        # Started again if a worker has exited
+        pool._workers[0].process.terminate()
+        pool._workers[0].process.join()
+        classifier.reload()
+        assert classifier.inception_model is not pool
+        assert pool._closed
+
+        # or the model file has been replaced
+        pool = classifier.inception_model
+        os.utime(model_file, (0, 0))
+        classifier.reload()
+        assert classifier.inception_model is not pool
+        assert classifier.classify_batch(_crops(3)).shape == (3, 2)
+        assert len(classifier.get_feature_vectors_from_files([])) == 0
+    finally:
+        classifier.close()
+    assert classifier.inception_model is None
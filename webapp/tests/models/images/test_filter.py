@@ -0,0 +1,112 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+
+from candysorter.config import get_config
+from candysorter.models.images.calibrate import ImageCalibrator
+from candysorter.models.images.detect import CandyDetector
+from candysorter.models.images.filter import (
+    _pickable, exclude_unpickables, load_pickable_map, make_pickable_map, pickable_at,
+    PICKABLE_MAP_FILE, pickable_mask, save_pickable_map
+)
+from tests.benchmarks.scenes import table_image
+
+
+@pytest.fixture(scope='module')
+def config():
+    return get_config('dev')
+
+
+@pytest.fixture(scope='module')
+def calibrator(config):
+    return ImageCalibrator.from_config(config)
+
+
+@pytest.fixture(scope='module')
+def adjust_data():
+    path = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..',
+                        'robot-arm', 'calibration', 'adjust_data.json')
+    with io.open(path) as f:
+        return json.load(f)
+
+
+def test_pickable_map_of_robot(adjust_data):
+    # The map is made again whenever the calibration data of the arm changes
+    assert np.array_equal(load_pickable_map(PICKABLE_MAP_FILE), make_pickable_map(adjust_data))
+
+    # The same cells as the arm looks up in AdjustForPictureToRobot.adjust
+    for key, value in adjust_data.items():
+        x, y = (float(v) for v in key.split(','))
+        if -1 <= x <= 1 and -1.5 <= y <= 1.5:
+            assert _pickable(x, y) == (value is not None)
+            assert _pickable(x + 0.04, y - 0.04) == (value is not None)
+
+
+def test_save_pickable_map(tmpdir):
+    pickables = np.random.RandomState(0).rand(31, 21) < 0.5
+    path = str(tmpdir.join('pickable_map.txt'))
+    save_pickable_map(path, pickables)
+    assert np.array_equal(load_pickable_map(path), pickables)
+
+
+def test_pickable_mask(calibrator):
+    mask = pickable_mask(calibrator)
+    w, h = calibrator.area
+    assert mask.shape == (h, w)
+    for y in range(0, h, 5):
+        for x in range(0, w, 5):
+            assert mask[y, x] == _pickable(*calibrator.get_coordinate(x, y))
+
+
+def test_pickable_at(calibrator):
+    rng = np.random.RandomState(0)
+    w, h = calibrator.area
+    points = np.stack([rng.randint(-100, w + 100, 1000), rng.randint(-100, h + 100, 1000)], axis=1)
+    expected = [_pickable(*calibrator.get_coordinate(x, y)) for x, y in points]
+    assert pickable_at(calibrator, points).tolist() == expected
+
+
+def test_exclude_unpickables(calibrator):
+    img, _ = table_image(40)
+    candies = CandyDetector().detect(img)
+    expected = exclude_unpickables(calibrator, list(candies))
+    actual = exclude_unpickables(calibrator, candies)
+    assert [c.box_centroid for c in actual] == [c.box_centroid for c in expected]
+    assert np.array_equal(actual.coordinates(calibrator),
+                          [calibrator.get_coordinate(*c.box_centroid) for c in expected])
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'scale': 0.5}, {'workers': 2}])
+def test_detect_in_reach(config, calibrator, kwargs):
+    img, _ = table_image(40, touch=0.3)
+    detector = CandyDetector.from_config(config)
+    for k, v in kwargs.items():
+        setattr(detector, k, v)
+    expected = exclude_unpickables(calibrator, detector.detect(img))
+
+    detector.set_reach(pickable_mask(calibrator), config.CANDY_DETECTOR_REACH_MARGIN)
+    candies = detector.detect(img)
+    actual = exclude_unpickables(calibrator, candies)
+    assert len(actual) < len(candies)
+    assert (sorted((c.box_centroid, c.box_dims) for c in actual) ==
+            sorted((c.box_centroid, c.box_dims) for c in expected))
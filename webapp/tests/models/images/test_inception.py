@@ -0,0 +1,108 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cv2
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from trainer.feature_extractor import (  # noqa: E402
+    FEATURE_TENSOR_NAME, FeatureExtractor, INPUT_DATA_TENSOR_NAME, resize_bilinear
+)
+from trainer.optimize import (  # noqa: E402
+    compare, cosine_similarities, optimize_graph, synthetic_images
+)
+from tests.models.images.graphs import inception_graph_def, write_inception_graph  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def model_file(tmpdir_factory):
+    return write_inception_graph(str(tmpdir_factory.mktemp('inception').join('graph.pb')))
+
+
+def _imgs(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randint(0, 256, (50 + 40 * i, 320 - 30 * i, 3)).astype(np.uint8)
+            for i in range(n)]
+
+
+def _features_by_decode_jpeg(imgs):
+    # Each image fed to DecodeJpeg of the unmodified graph
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(inception_graph_def(), name='')
+        with tf.Session(graph=graph) as sess:
+            return np.concatenate([sess.run(FEATURE_TENSOR_NAME, {INPUT_DATA_TENSOR_NAME: img})
+                                   for img in imgs])
+
+
+def test_resize_bilinear():
+    img = _imgs(1)[0]
+    with tf.Graph().as_default(), tf.Session() as sess:
+        expected = sess.run(tf.image.resize_bilinear(img[np.newaxis].astype(np.float32),
+                                                     [299, 299]))
+    actual = resize_bilinear(img)
+    assert actual.dtype == np.float32
+    assert np.allclose(actual, expected[0], atol=1e-3)
+
+
+def test_feature_vectors(model_file):
+    imgs = _imgs(5)
+    expected = _features_by_decode_jpeg(imgs)
+
+    with FeatureExtractor(model_file) as extractor:
+        for batch_size in [16, 2]:
+            actual = extractor.get_feature_vectors(imgs, batch_size=batch_size)
+            assert actual.shape == (5, 2048)
+            assert np.allclose(actual, expected, rtol=1e-4, atol=1e-5)
+        assert np.allclose(extractor.get_feature_vector(imgs[0]), expected[:1], rtol=1e-4,
+                           atol=1e-5)
+        assert extractor.get_feature_vectors([]).shape == (0, 2048)
+
+
+def test_feature_vectors_from_files(model_file, tmpdir):
+    paths = []
+    for i, img in enumerate(_imgs(3)):
+        paths.append(str(tmpdir.join('{}.jpg'.format(i))))
+        cv2.imwrite(paths[-1], img)
+    # As TensorFlow decodes them
+    decoded = [cv2.imread(p)[:, :, ::-1] for p in paths]
+
+    with FeatureExtractor(model_file) as extractor:
+        actual = extractor.get_feature_vectors_from_files(paths)
+    assert len(actual) == 3
+    assert np.allclose(np.stack(actual), _features_by_decode_jpeg(decoded), rtol=1e-3, atol=1e-4)
+
+
+@pytest.mark.parametrize('quantize, min_cosine', [(False, 0.99999), (True, 0.99)])
+def test_optimize_graph(model_file, tmpdir, quantize, min_cosine):
+    graph_def = inception_graph_def()
+    optimized = optimize_graph(graph_def, quantize=quantize, min_quantize_size=2048)
+    ops = {n.op for n in optimized.node}
+    assert not ops & {'DecodeJpeg', 'BatchNormWithGlobalNormalization', 'Softmax'}
+    assert ('Cast' in ops) == quantize
+    optimized_file = str(tmpdir.join('optimized.pb'))
+    with open(optimized_file, 'wb') as f:
+        f.write(optimized.SerializeToString())
+
+    imgs = synthetic_images(n=5)
+    (expected, _, _), (actual, _, _) = compare(model_file, optimized_file, imgs, repeat=1)
+    assert expected.shape == actual.shape == (5, 2048)
+    assert np.allclose(expected, _features_by_decode_jpeg(imgs), rtol=1e-4, atol=1e-5)
+    assert cosine_similarities(expected, actual).min() > min_cosine
+    if not quantize:
+        assert np.allclose(actual, expected, rtol=1e-3, atol=1e-4)
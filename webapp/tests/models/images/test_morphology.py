@@ -0,0 +1,79 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cv2
+import numpy as np
+import pytest
+
+from candysorter.models.images import morphology
+
+_KERNEL = np.ones((3, 3), np.uint8)
+ITERATIONS = [0, 1, 2, 5, 14, 15, 25, 40]
+
+
+def _mask(seed, shape=(300, 400), n=30):
+    # Blobs of all sizes, also touching the border of the image, and salt noise
+    rng = np.random.RandomState(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(n):
+        center = (rng.randint(-20, shape[1] + 20), rng.randint(-20, shape[0] + 20))
+        axes = (rng.randint(2, 120), rng.randint(2, 120))
+        cv2.ellipse(mask, center, axes, rng.randint(0, 180), 0, 360, 255, -1)
+    mask[rng.rand(*shape) < 0.01] = 255
+    mask[rng.rand(*shape) < 0.01] = 0
+    return mask
+
+
+def _iterated(mask, steps):
+    # Repeats each step of the 3x3 kernel, e.g. closing is k dilations then k erosions
+    for op, iterations in steps:
+        for _ in range(iterations):
+            mask = op(mask, _KERNEL)
+    return mask
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('iterations', ITERATIONS)
+@pytest.mark.parametrize('name, op, steps', [
+    ('erode', cv2.MORPH_ERODE, lambda k: [(cv2.erode, k)]),
+    ('dilate', cv2.MORPH_DILATE, lambda k: [(cv2.dilate, k)]),
+    ('closing', cv2.MORPH_CLOSE, lambda k: [(cv2.dilate, k), (cv2.erode, k)]),
+    ('opening', cv2.MORPH_OPEN, lambda k: [(cv2.erode, k), (cv2.dilate, k)]),
+])
+def test_equals_iterated_kernel(seed, iterations, name, op, steps):
+    mask = _mask(seed)
+    expected = _iterated(mask, steps(iterations))
+    if iterations > 0:
+        assert np.array_equal(cv2.morphologyEx(mask, op, _KERNEL, iterations=iterations),
+                              expected)
+
+    assert np.array_equal(getattr(morphology, name)(mask, iterations), expected)
+
+    dst = mask.copy()
+    actual = getattr(morphology, name)(dst, iterations, dst=dst)
+    assert actual is dst
+    assert np.array_equal(dst, expected)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('a, b', [(1, 4), (5, 20), (5, 10), (14, 1)])
+def test_erosions_compose(seed, a, b):
+    mask = _mask(seed)
+    assert np.array_equal(morphology.erode(morphology.erode(mask, a), b),
+                          morphology.erode(mask, a + b))
+    assert np.array_equal(morphology.dilate(morphology.dilate(mask, a), b),
+                          morphology.dilate(mask, a + b))
@@ -0,0 +1,84 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+import json
+
+import cv2
+import numpy as np
+
+from candysorter.config import get_config
+from candysorter.models.images.detect import CandyDetector
+from candysorter.models.images.tune import (
+    config_block, load_dataset, pareto_frontier, params_of, sample_params, score, Trial, tune
+)
+from tests.benchmarks.scenes import table_image
+
+
+def _save_scene(directory, name, n_candies, seed):
+    img, boxes = table_image(n_candies, seed=seed)
+    cv2.imwrite(str(directory.join(name + '.png')), img)
+    directory.join(name + '.json').write(
+        json.dumps([dict(box=cv2.boxPoints(box).tolist()) for box in boxes]))
+
+
+def test_tune(tmpdir):
+    _save_scene(tmpdir, 'a', 10, seed=1)
+    _save_scene(tmpdir, 'b', 20, seed=2)
+    tmpdir.join('c.png').write('')
+    dataset = load_dataset(str(tmpdir))
+    assert [len(boxes) for _, boxes in dataset] == [10, 20]
+
+    base = params_of(get_config('dev'))
+    params_list = sample_params(base, 3)
+    assert params_list[0] == base
+    assert len(set(tuple(p.values()) for p in params_list)) == 3
+
+    trials = tune(dataset, params_list, processes=2, repeat=1)
+    assert [t.params for t in trials] == params_list
+    for t in trials:
+        assert 0 <= t.precision <= 1 and 0 <= t.recall <= 1 and t.latency > 0
+    assert trials[0].recall > 0.7
+
+
+def test_score():
+    img, boxes = table_image(10, seed=1)
+    candies = CandyDetector.from_config(get_config('dev')).detect(img)
+    boxes = [cv2.boxPoints(box) for box in boxes]
+    # Touching candies of the scene may be found as one
+    assert len(boxes) - 2 <= score(candies, boxes) == len(candies)
+    assert score(list(candies) * 2, boxes) == len(candies)
+    assert score(candies, boxes[:5]) <= 5
+    assert score([], boxes) == 0
+
+
+def test_pareto_frontier():
+    trials = [Trial({}, 0, 0, f1, latency)
+              for f1, latency in [(0.9, 3.0), (0.8, 1.0), (0.8, 2.0), (0.95, 5.0), (0.7, 4.0)]]
+    assert [(t.f1, t.latency) for t in pareto_frontier(trials)] == [
+        (0.8, 1.0), (0.9, 3.0), (0.95, 5.0)
+    ]
+
+
+def test_config_block():
+    block = config_block(OrderedDict([('margin', [30, 30]), ('restore_fg_thres', np.float64(0.5)),
+                                      ('solidity_thres', None)]))
+    assert block.split('\n') == [
+        '    CANDY_DETECTOR_MARGIN           = (30, 30)',
+        '    CANDY_DETECTOR_RESTORE_FG_THRES = 0.5',
+        '    CANDY_DETECTOR_SOLIDITY_THRES   = None',
+    ]
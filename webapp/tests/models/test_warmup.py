@@ -0,0 +1,140 @@
+# Copyright 2017 BrainPad Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+import numpy as np
+import pytest
+
+from candysorter.models.images.detect import CandyDetector, DetectorWorkspace
+from candysorter.models.warmup import _table_image, WarmUp
+
+
+class _TextAnalyzer(object):
+    labels = ['SWEET CHOCOLATE', 'SOUR GUMMY']
+    models = None
+
+    def __init__(self):
+        self.calls = []
+
+    def calc_similarities(self, tokens, lang='en'):
+        self.calls.append(([(t.lemma, t.pos.tag) for t in tokens], lang))
+        return np.linspace(0.9, 0.1, len(self.labels))
+
+
+class _Classifier(object):
+    def __init__(self, error=None):
+        self.error = error
+        self.crops = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def warm_up(self, imgs_bgr):
+        self.entered.set()
+        self.release.wait()
+        if self.error:
+            raise self.error
+        self.crops.append(imgs_bgr)
+        return np.zeros((len(imgs_bgr), 2))
+
+
+def test_warm_up():
+    text_analyzer, classifier = _TextAnalyzer(), _Classifier()
+    warm_up = WarmUp(text_analyzer, CandyDetector(), classifier, n_candies=8)
+    assert not warm_up.ready and not warm_up.running
+
+    warm_up.start().join()
+    assert warm_up.ready and not warm_up.running
+    assert list(warm_up.timings) == ['text_en', 'detection', 'classification']
+    assert text_analyzer.calls == [([('sweet', 'NOUN'), ('chocolate', 'NOUN'), ('sour', 'NOUN'),
+                                     ('gummy', 'NOUN')], 'en')]
+    # The candies detected in the synthetic table
+    assert len(classifier.crops[0]) == 8
+
+    # Not ready again until the run after a reload has finished
+    classifier.release.clear()
+    classifier.entered.clear()
+    thread = warm_up.start()
+    classifier.entered.wait()
+    assert not warm_up.ready and warm_up.running
+    classifier.release.set()
+    thread.join()
+    assert warm_up.ready
+
+
+def test_warm_up_errors():
+    warm_up = WarmUp(_TextAnalyzer(), CandyDetector(), _Classifier(error=IOError('No model.')))
+    warm_up.start().join()
+    assert not warm_up.ready and not warm_up.running
+    assert warm_up.errors == ['classification']
+    assert list(warm_up.timings) == ['text_en', 'detection']
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'scale': 0.5}, {'workers': 2}])
+def test_warm_up_detector(monkeypatch, kwargs):
+    detector = CandyDetector(**kwargs)
+    WarmUp(_TextAnalyzer(), detector, _Classifier()).start().join()
+
+    # Detection on another thread than the warm-up allocates no buffers
+    allocated = []
+    init = DetectorWorkspace.__init__
+    monkeypatch.setattr(DetectorWorkspace, '__init__',
+                        lambda self, shape: allocated.append(shape) or init(self, shape))
+    img, _ = _table_image((1625, 1100), 10, seed=1)
+    assert len(detector.detect(img)) == 10
+    assert allocated == []
+    detector.close()
+
+
+def test_warm_up_without_candies():
+    # e.g. all out of the reach of the arm
+    detector = CandyDetector()
+    detector.set_reach(np.zeros((1100, 1625), dtype=bool))
+    classifier = _Classifier()
+    warm_up = WarmUp(_TextAnalyzer(), detector, classifier, n_candies=5)
+    warm_up.start().join()
+    assert warm_up.ready
+    assert len(classifier.crops[0]) == 5
+
+
+def test_warm_up_inception(tmpdir):
+    # A scene of several candies through inception-v3 of a batch of one and the transfer model
+    pytest.importorskip('tensorflow')
+    from candysorter.models.images.classify import CandyClassifier
+    from tests.models.images.graphs import write_inception_graph
+
+    rng = np.random.RandomState(0)
+    np.savez(str(tmpdir.join('weights.npz')), hidden_weights=rng.randn(2048, 8),
+             hidden_biases=np.zeros(8), logits_weights=rng.randn(8, 2), logits_biases=np.zeros(2))
+    classifier = CandyClassifier(
+        checkpoint_dir=str(tmpdir), params_file=str(tmpdir.join('params.json')),
+        inception_model_file=write_inception_graph(str(tmpdir.join('graph.pb'))))
+    classifier.init()
+    try:
+        warm_up = WarmUp(_TextAnalyzer(), CandyDetector(), classifier, n_candies=10)
+        warm_up.start().join()
+        assert warm_up.errors == []
+        assert warm_up.ready
+        assert list(warm_up.timings) == ['text_en', 'detection', 'classification']
+        assert classifier.classify_batch(_table_crops(3)).shape == (3, 2)
+    finally:
+        classifier.close()
+
+
+def _table_crops(n):
+    return [np.full((60 + 10 * i, 80, 3), 100 + i, dtype=np.uint8) for i in range(n)]